@@ -0,0 +1,143 @@
+import argparse
+from collections import Counter
+import datetime
+import os
+import time
+from urllib.parse import urlparse
+
+from db import DB
+
+"""
+Click aggregation job
+~~~~~~~~~~~~~~~~~~~~~
+
+Incrementally folds the click events of the `url_clicks` collections into
+per url rollups read by GET /api/urls/{code}/stats. Every run picks up from
+the last checkpoint:
+
+    python aggregate.py              # single run
+    python aggregate.py --every 60   # keep running, once a minute
+
+Events are stamped by the clock of their shard server and read in that
+order, so clicks ingested late from CDN logs are counted in the bucket of
+their own date, and workers with skewed clocks never log behind the
+checkpoint. Each shard keeps its own checkpoint, so a run failing on one
+shard never counts the others twice when retried. Events are removed by
+mongo after a month, longer than this job may ever be stopped. Stop it while
+rebalance.py runs.
+
+Rollups
+-------
+    {
+        'code': 'short_url code',
+        'dimension': 'minute' | 'hour' | 'day' | 'referrer' | 'user_agent',
+        'key': 'bucket timestamp, referrer host or user agent',
+        'clicks': 10
+    }
+"""
+
+CHECKPOINT = 'click_rollups'
+
+# accesses logged less than LAG seconds ago are left for the next run, so
+# writes still in flight are not skipped
+LAG = 5
+
+MAX_USER_AGENT_LEN = 200
+
+TIME_DIMENSIONS = {
+    'minute': lambda date: date.replace(second=0, microsecond=0),
+    'hour': lambda date: date.replace(minute=0, second=0, microsecond=0),
+    'day': lambda date: date.replace(hour=0, minute=0, second=0,
+                                     microsecond=0),
+}
+
+
+def referrer_key(referrer):
+    """
+    Referrers are grouped by host, clicks without one are `direct`
+    """
+    if not referrer:
+        return 'direct'
+    return urlparse(referrer).netloc.lower() or 'direct'
+
+
+def user_agent_key(user_agent):
+    if not user_agent:
+        return 'unknown'
+    return user_agent[:MAX_USER_AGENT_LEN]
+
+
+def rollup_counts(events):
+    """
+    Counts access events per (code, dimension, key)
+    """
+    counts = Counter()
+    for event in events:
+        code = event['code']
+        for dimension, bucket in TIME_DIMENSIONS.items():
+            counts[(code, dimension, bucket(event['date']))] += 1
+        counts[(code, 'referrer', referrer_key(event.get('referrer')))] += 1
+        counts[(code, 'user_agent',
+                user_agent_key(event.get('user_agent')))] += 1
+    return counts
+
+
+def aggregate(db, until=None):
+    """
+    Folds the accesses logged since the last checkpoint into the rollups,
+    up to `until`, LAG seconds ago by the clock of each shard by default.
+    Returns the number of accesses processed
+    """
+    # shards added since the last run start from the last complete run
+    last_run = db.get_checkpoint(CHECKPOINT)
+
+    processed = 0
+    run_until = None
+    # rollups are stored next to their urls, so each shard is folded alone
+    for urls in db.url_collections():
+        shard_until = until or (db.server_time(urls) -
+                                datetime.timedelta(seconds=LAG))
+        # mongo keeps milliseconds, a checkpoint must read back as saved
+        shard_until = shard_until.replace(
+            microsecond=shard_until.microsecond // 1000 * 1000)
+        run_until = min(run_until or shard_until, shard_until)
+
+        since = db.get_checkpoint(CHECKPOINT, urls) or last_run
+        if since and since >= shard_until:
+            continue
+
+        counts = rollup_counts(db.find_access_events(urls, since,
+                                                     shard_until))
+        db.inc_rollups(urls, counts)
+        db.set_checkpoint(CHECKPOINT, shard_until, urls)
+        processed += sum(clicks for (_, dimension, _), clicks in
+                         counts.items() if dimension == 'day')
+
+    if run_until and (not last_run or last_run < run_until):
+        db.set_checkpoint(CHECKPOINT, run_until)
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Click aggregation job')
+    parser.add_argument('--every', type=int, default=0,
+                        help='run forever, every EVERY seconds')
+    args = parser.parse_args()
+
+    shard_uris = DB.parse_shard_uris(os.environ.get('MONGODB_SHARD_URIS'))
+    db = DB(os.environ.get('MONGODB_URI'), shard_uris=shard_uris)
+    try:
+        while True:
+            started = time.time()
+            processed = aggregate(db)
+            print('processed={} took={:.2f}s'.format(
+                processed, time.time() - started))
+            if not args.every:
+                break
+            time.sleep(args.every)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,22 @@
 import datetime
+import hmac
+import os
 
 import hug
-from falcon import HTTP_400, HTTP_409, HTTP_201, HTTP_404, HTTP_500
+from falcon import (HTTP_204, HTTP_304, HTTP_400, HTTP_403, HTTP_409,
+                    HTTP_201, HTTP_404, HTTP_410, HTTP_500)
+from falcon.util import dt_to_http
 
+from aggregate import TIME_DIMENSIONS
 from db import DB
 from bson.objectid import ObjectId
-from middlewares import HostEnvMiddleware, MongoMiddleware
-from helpers import clean_url, clean_email, gen_api_key, serialize_url
+import formats
+from middlewares import HostEnvMiddleware, MongoMiddleware, RateLimitMiddleware
+from helpers import (api_key_fields, canonicalize_url, check_api_key,
+                     clean_url, clean_email, etag_matches, gen_api_key,
+                     parse_datetime, redirect_cache_control, serialize_url,
+                     short_url_code, short_url_for, split_api_key, url_etag,
+                     url_expired, url_hash)
 
 """
 EF URL SHORTENER API
@@ -18,9 +28,11 @@ Routes
     GET  /api/short?long_url=URL
     GET  /api/expand?short_url=URL
     GET  /api/urls/{code}
+    GET  /api/urls/{code}/stats
     GET  /api/urls/
     POST /api/user/
     GET  /s/:code
+    POST /s/:code/beacon
 
 
 Schemas
@@ -28,13 +40,21 @@ Schemas
     - url
         {
             'user_id': 'some_user_id',
-            'short_url': 'some_url',
-            'long_url': 'long_url_version',
+            'long_url': 'canonical long_url version',
+            'long_url_hash': BinData('128 bits hash of long_url'),
             'code': 'short_url code',
             'created_at': 'timestamp',
+            'updated_at': 'timestamp',
             'created_by': 'user_id',
+            'expires_at': 'timestamp, optional',
+            'max_clicks': 'max number of accesses, optional',
             'url_access': [
-                {'date': 'timestamp'},
+                {
+                    'date': 'timestamp',
+                    'logged_at': 'timestamp',
+                    'referrer': 'referer header',
+                    'user_agent': 'user agent header'
+                },
                 ...
             ]
         }
@@ -42,7 +62,9 @@ Schemas
     - user
         {
             'email': 'some@email.com',
-            'api_key': 'api_key'
+            'last_write_at': 'timestamp of the last url created',
+            'api_key_prefix': 'public api key prefix',
+            'api_key_hash': BinData('sha256 of the api key secret')
         }
 
 """
@@ -72,8 +94,13 @@ def verify(request):
     """
     api_key = request.get_header('X-Api-Key')
     db = request.context['db']
-    user = db.find_one_user({'api_key': api_key})
-    if not user:
+    try:
+        prefix, secret = split_api_key(api_key)
+    except ValueError:
+        return False
+
+    user = db.find_one_user({'api_key_prefix': prefix})
+    if not user or not check_api_key(user, secret):
         return False
     return user
 
@@ -81,6 +108,55 @@ def verify(request):
 auth_user = api_key(verify)
 
 
+"""
+HTTP caching
+"""
+
+# Cache-Control sent with redirects, eg. `public, max-age=300` to let a CDN
+# absorb redirect traffic. Unset keeps redirects uncacheable by shared caches
+REDIRECT_CACHE_CONTROL = os.environ.get('REDIRECT_CACHE_CONTROL')
+
+# How clicks are counted:
+#   inline - /s/:code logs every access (default)
+#   beacon - the CDN edge reports hits to POST /s/:code/beacon
+#   log    - hits are loaded from CDN access logs with ingest_clicks.py
+# Click limited urls are always counted inline.
+CLICK_TRACKING = os.environ.get('CLICK_TRACKING', 'inline')
+
+# Shared secret the CDN edge sends in X-Beacon-Secret. Beacons are refused
+# while unset
+BEACON_SECRET = os.environ.get('BEACON_SECRET', '')
+
+
+def access_log(request):
+    """
+    Access log entry for a click
+    """
+    return {
+        'date': datetime.datetime.utcnow(),
+        'referrer': request.referer,
+        'user_agent': request.user_agent,
+    }
+
+
+def not_modified(request, response, url, variant):
+    """
+    Adds cache validators for `url` to the response and checks the request
+    If-None-Match header. Returns True when a 304 must be returned
+    """
+    etag = url_etag(url, variant)
+    updated_at = url.get('updated_at') or url['created_at']
+    response.set_header('ETag', etag)
+    response.set_header('Last-Modified', dt_to_http(updated_at))
+    # per user data: clients may keep it, but must revalidate
+    response.set_header('Cache-Control', 'private, no-cache')
+
+    if etag_matches(request.get_header('If-None-Match'), etag):
+        response.status = HTTP_304
+        return True
+    return False
+
+
 """
 Middlewares
 """
@@ -88,9 +164,15 @@ Middlewares
 
 api = hug.API(__name__)
 
+# orjson based output, with native datetime handling
+api.http.output_format = formats.json
+
 # adding host on request.context
 api.http.add_middleware(HostEnvMiddleware())
 
+# rejecting abusive clients before touching mongodb
+api.http.add_middleware(RateLimitMiddleware())
+
 # adding mongodb connection to request.context
 api.http.add_middleware(MongoMiddleware())
 
@@ -115,10 +197,11 @@ def short_url(request, response):
         return {'error': 'long_url GET param missing'}
 
     long_url = request.params['long_url']
+    sort_query = request.params.get('sort_query') in ('1', 'true')
 
     # validate url
     try:
-        long_url = clean_url(long_url)
+        long_url = canonicalize_url(long_url, sort_query=sort_query)
     except ValueError:
         response.status = HTTP_400
         return {'error': 'long_url is not a valid URL'}
@@ -129,35 +212,70 @@ def short_url(request, response):
         response.status = HTTP_400
         return {'error': 'Code param must have a max length of 9'}
 
-    # check if url already exists
+    now = datetime.datetime.utcnow()
+
+    # validate expiry
+    expires_at = request.params.get('expires_at')
+    if expires_at:
+        try:
+            expires_at = parse_datetime(expires_at)
+        except ValueError:
+            response.status = HTTP_400
+            return {'error': 'expires_at GET param is not valid'}
+
+        if expires_at <= now:
+            response.status = HTTP_400
+            return {'error': 'expires_at must be in the future'}
+
+    max_clicks = request.params.get('max_clicks')
+    if max_clicks:
+        try:
+            max_clicks = int(max_clicks)
+        except ValueError:
+            max_clicks = 0
+
+        if max_clicks < 1:
+            response.status = HTTP_400
+            return {'error': 'max_clicks GET param must be a positive integer'}
+
+    # check if url already exists, long urls are matched by their hash
+    long_url_hash = url_hash(long_url)
     if code:
-        query = db.find_one_url({'code': code,
-                                 'created_by': ObjectId(user['_id'])})
+        query = {'code': code, 'created_by': ObjectId(user['_id'])}
     else:
-        query = db.find_one_url({'long_url': long_url,
-                                 'created_by': ObjectId(user['_id'])})
+        query = {'long_url_hash': long_url_hash,
+                 'created_by': ObjectId(user['_id'])}
 
-    exists = db.find_one_url(query)
+    exists = db.find_one_url(query, {'_id': 1})
     if exists:
         response.status = HTTP_409
         return {'error': 'long_url already exists'}
 
+    # codes are never reissued, even once their url is archived
+    if code and db.code_exists(code):
+        response.status = HTTP_409
+        return {'error': 'code is not available'}
+
     # create url
     code = code or db.generate_url_code(host)
-    short_url = '{}/{}'.format(host, code)
     url = {
-        'short_url': short_url,
         'long_url': long_url,
+        'long_url_hash': long_url_hash,
         'code': code,
         'url_access': [],
-        'created_at': datetime.datetime.now(),
+        'created_at': now,
+        'updated_at': now,
         'created_by': ObjectId(user['_id']),
     }
+    if expires_at:
+        url['expires_at'] = expires_at
+    if max_clicks:
+        url['max_clicks'] = max_clicks
 
     db.insert_url(url)
 
     response.status = HTTP_201
-    return {'short_url': short_url}
+    return {'short_url': short_url_for(host, code)}
 
 
 @hug.get('/api/expand', requires=auth_user)
@@ -167,6 +285,7 @@ def expand_url(request, response):
     """
     db = request.context['db']
     user = request.context['user']
+    host = request.context['host']
 
     # validating query params
     if 'short_url' not in request.params:
@@ -180,15 +299,23 @@ def expand_url(request, response):
         response.status = HTTP_400
         return {'error': 'short_url is not a valid URL'}
 
-    # check if url exists
-    url = db.find_one_url({'short_url': short_url,
-                           'created_by': ObjectId(user['_id'])})
+    # check if url exists, looking it up by code
+    code = short_url_code(short_url, host)
+    url = code and db.find_one_url({'code': code,
+                                    'created_by': ObjectId(user['_id'])},
+                                   read='lookup',
+                                   written_at=user.get('last_write_at'))
     if not url:
         response.status = HTTP_404
         return {'error': 'short_url does not exist'}
 
+    if not_modified(request, response, url, 'expand'):
+        return ''
+
+    # the canonical short url, so every spelling gets the same body as the
+    # etag it shares
     return {
-        'short_url': request.params['short_url'],
+        'short_url': short_url_for(host, code),
         'long_url': url['long_url'],
     }
 
@@ -205,12 +332,11 @@ def get_user_urls(request, response):
         response.status = HTTP_400
         return {'error': 'page GET param is not valid'}
 
-    urls = db.find_urls(request.context['user']['_id'], page=page)
-    serialized = []
-    for url in urls:
-        serialized.append(serialize_url(url))
-
-    return serialized
+    host = request.context['host']
+    user = request.context['user']
+    urls = db.find_urls(user['_id'], page=page, read='list',
+                        written_at=user.get('last_write_at'))
+    return [serialize_url(url, host) for url in urls]
 
 
 @hug.get('/api/urls/{code}', requires=auth_user)
@@ -219,15 +345,72 @@ def get_user_url(request, response, code):
     return user url by code
     """
     db = request.context['db']
+    user = request.context['user']
     url = db.find_one_url({
         'code': code,
-        'created_by': ObjectId(request.context['user']['_id'])
-    })
+        'created_by': ObjectId(user['_id'])
+    }, read='lookup', written_at=user.get('last_write_at'))
     if not url:
         response.status = HTTP_404
         return {'error': 'URL does not exist'}
 
-    return serialize_url(url)
+    if not_modified(request, response, url, 'url'):
+        return ''
+
+    return serialize_url(url, request.context['host'])
+
+
+STATS_LIMIT = 60
+MAX_STATS_LIMIT = 1000
+
+
+@hug.get('/api/urls/{code}/stats', requires=auth_user)
+def get_url_stats(request, response, code):
+    """
+    Return url click stats, read from the rollups built by aggregate.py
+    """
+    db = request.context['db']
+
+    granularity = request.params.get('granularity', 'hour')
+    if granularity not in TIME_DIMENSIONS:
+        response.status = HTTP_400
+        return {'error': 'granularity GET param must be one of {}'.format(
+            ', '.join(sorted(TIME_DIMENSIONS)))}
+
+    try:
+        limit = int(request.params.get('limit', STATS_LIMIT))
+    except ValueError:
+        response.status = HTTP_400
+        return {'error': 'limit GET param is not valid'}
+    limit = min(max(limit, 1), MAX_STATS_LIMIT)
+
+    user = request.context['user']
+    url = db.find_one_url({
+        'code': code,
+        'created_by': ObjectId(user['_id'])
+    }, read='lookup', written_at=user.get('last_write_at'))
+    if not url:
+        response.status = HTTP_404
+        return {'error': 'URL does not exist'}
+
+    # most recent buckets first from mongo, returned oldest first
+    clicks = list(db.find_rollups(code, granularity, limit, read='stats'))
+    by_clicks = [('clicks', -1)]
+    referrers = db.find_rollups(code, 'referrer', limit, sort=by_clicks,
+                                read='stats')
+    user_agents = db.find_rollups(code, 'user_agent', limit, sort=by_clicks,
+                                  read='stats')
+
+    return {
+        'code': code,
+        'granularity': granularity,
+        'clicks': [{'date': i['key'], 'clicks': i['clicks']}
+                   for i in reversed(clicks)],
+        'referrers': [{'referrer': i['key'], 'clicks': i['clicks']}
+                      for i in referrers],
+        'user_agents': [{'user_agent': i['key'], 'clicks': i['clicks']}
+                        for i in user_agents],
+    }
 
 
 @hug.post('/api/user')
@@ -254,11 +437,13 @@ def create_user(body, request, response):
         response.status = HTTP_409
         return {'error': 'User already exists'}
 
+    # only the key prefix and a hash of the secret are stored
+    api_key = gen_api_key()
     user = {
         'email': email,
-        'api_key': gen_api_key(email),
-        'created_at': datetime.datetime.now()
+        'created_at': datetime.datetime.utcnow()
     }
+    user.update(api_key_fields(api_key))
 
     # creating user
     result = db.insert_user(user)
@@ -266,7 +451,7 @@ def create_user(body, request, response):
         response.status = HTTP_500
         return {'error': 'Error on creating user. Internal Error'}
 
-    return {'api_key': user['api_key']}
+    return {'api_key': api_key}
 
 
 """
@@ -282,14 +467,70 @@ def go_to(request, response, code):
     db = request.context['db']
 
     # checking if url exists
-    url = db.find_one_url({'code': code})
+    url = db.find_one_url({'code': code}, read='redirect')
+
+    # click limits need an up to date click count
+    if url and url.get('max_clicks'):
+        url = db.find_one_url({'code': code})
+
     if not url:
         response.status = HTTP_404
         return {'error': 'URL not found'}
 
-    # add url access log
-    access = {'date': datetime.datetime.now()}
-    db.update_url({'_id': url['_id']}, {'$addToSet': {'url_access': access}})
-
-    # redirecting user to url
+    # lazy expiry, expired urls stay until archive.py moves them
+    now = datetime.datetime.utcnow()
+    if url_expired(url, now):
+        response.status = HTTP_410
+        return {'error': 'URL expired'}
+
+    # add url access log. Click limited urls are never served from a cache,
+    # so their clicks are counted here whatever the tracking mode. Each
+    # redirect claims one of the allowed clicks, and concurrent ones losing
+    # the last click are refused
+    max_clicks = url.get('max_clicks')
+    if max_clicks:
+        result = db.log_access(url['code'], access_log(request),
+                               max_clicks=max_clicks)
+        if not result.matched_count:
+            response.status = HTTP_410
+            return {'error': 'URL expired'}
+
+        # the last allowed click expires the url
+        db.expire_url(url['code'], now, max_clicks=max_clicks)
+    elif CLICK_TRACKING == 'inline':
+        db.log_access(url['code'], access_log(request))
+
+    # redirecting user to url. There is no redirect cache on our side, so
+    # caches downstream must not keep an expiring url longer than it lives
+    cache_control = redirect_cache_control(url, REDIRECT_CACHE_CONTROL, now)
+    if cache_control:
+        response.set_header('Cache-Control', cache_control)
     return hug.redirect.permanent(url['long_url'])
+
+
+@hug.post('/s/{code}/beacon')
+def click_beacon(request, response, code):
+    """
+    Click report sent by the CDN edge when a redirect is served from cache.
+    Only served with beacon tracking, to callers knowing the shared secret
+    """
+    if CLICK_TRACKING != 'beacon':
+        response.status = HTTP_404
+        return {'error': 'URL not found'}
+
+    secret = request.get_header('X-Beacon-Secret') or ''
+    if not BEACON_SECRET or not hmac.compare_digest(
+            secret.encode('utf-8'), BEACON_SECRET.encode('utf-8')):
+        response.status = HTTP_403
+        return {'error': 'Invalid beacon secret'}
+
+    # click limited urls are logged inline on redirect, a beacon for them
+    # would count the click twice
+    db = request.context['db']
+    result = db.log_access(code, access_log(request), skip_limited=True)
+    if not result.matched_count:
+        response.status = HTTP_404
+        return {'error': 'URL not found'}
+
+    response.status = HTTP_204
+    return ''
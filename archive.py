@@ -0,0 +1,60 @@
+import argparse
+import datetime
+import os
+
+from db import DB
+
+"""
+Dead url archiver
+~~~~~~~~~~~~~~~~~
+
+Moves long dead urls, with their access logs, out of the urls collection and
+into urls_archive. A url is dead when it expired (by date or by reaching its
+click limit) more than --expired-days ago. Expired urls are only removed
+from here, and answer 410 until then, so run this daily:
+
+    python archive.py --expired-days 1
+
+Urls without expiry are permanent and kept, unless --idle-days is given:
+urls not clicked for that many days are then archived too, and their short
+urls answer 404.
+"""
+
+EXPIRED_DAYS = 1
+
+
+def dead_urls_query(now, expired_days=EXPIRED_DAYS, idle_days=None):
+    """
+    Query matching dead urls, idle ones only when `idle_days` is given
+    """
+    expired = now - datetime.timedelta(days=expired_days)
+    query = {'expires_at': {'$lte': expired}}
+    if not idle_days:
+        return query
+
+    idle = now - datetime.timedelta(days=idle_days)
+    return {'$or': [query, {'updated_at': {'$lte': idle}}]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dead url archiver')
+    parser.add_argument('--expired-days', type=int, default=EXPIRED_DAYS,
+                        help='archive urls expired for this many days')
+    parser.add_argument('--idle-days', type=int,
+                        help='also archive urls not clicked for this many '
+                             'days, even permanent ones')
+    args = parser.parse_args()
+
+    shard_uris = DB.parse_shard_uris(os.environ.get('MONGODB_SHARD_URIS'))
+    db = DB(os.environ.get('MONGODB_URI'), shard_uris=shard_uris)
+    try:
+        query = dead_urls_query(datetime.datetime.utcnow(),
+                                args.expired_days, args.idle_days)
+        archived = db.archive_urls(query)
+    finally:
+        db.close()
+    print('archived={}'.format(archived))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import DB  # noqa: E402
+from migrations import (  # noqa: E402
+    INDEXES_V1, INDEXES_V4, INDEXES_V6, INDEXES_V7, SCHEMA_VERSION,
+    build_indexes, migrate
+)
+
+"""
+Worker boot benchmark
+~~~~~~~~~~~~~~~~~~~~~
+
+Compares the mongo work a worker did at boot before migrations were run
+from the command line (building every index) with what it does now (a
+schema version read). Run against a copy of the production database:
+
+    MONGODB_URI=mongodb://localhost:27017/ef_copy python benchmarks/bench_boot.py
+"""
+
+ROUNDS = 10
+
+
+def live_indexes():
+    """
+    Every index spec of the migrated database, the latest one winning for
+    the same keys, as rebuilding a replaced spec fails with a conflict
+    """
+    specs = {}
+    for collection, keys, options in (INDEXES_V1 + INDEXES_V4 + INDEXES_V6 +
+                                      INDEXES_V7):
+        specs[(collection, str(keys))] = (collection, keys, options)
+    return list(specs.values())
+
+
+def boot_with_indexes(mongo_uri):
+    db = DB(mongo_uri)
+    build_indexes(db, live_indexes())
+    db.close()
+
+
+def boot_with_version_check(mongo_uri):
+    db = DB(mongo_uri)
+    assert db.get_schema_version() >= SCHEMA_VERSION
+    db.close()
+
+
+def main():
+    mongo_uri = os.environ.get('MONGODB_URI')
+    db = DB(mongo_uri)
+    migrate(db, out=lambda line: None)
+    db.close()
+
+    results = {}
+    for func in (boot_with_indexes, boot_with_version_check):
+        best = min(timeit.repeat(lambda: func(mongo_uri), number=1,
+                                 repeat=ROUNDS))
+        results[func.__name__] = best
+        print('{:<24} {:8.2f} ms'.format(func.__name__, best * 1000))
+    print('speedup {:>25.1f}x'.format(
+        results['boot_with_indexes'] / results['boot_with_version_check']))
+
+
+if __name__ == '__main__':
+    main()
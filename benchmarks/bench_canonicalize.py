@@ -0,0 +1,55 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import canonicalize_url, clean_url, url_hash  # noqa: E402
+
+"""
+URL canonicalization micro benchmark
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Compares clean_url with canonicalize_url (+ url_hash, as done on every
+/api/short call) on already canonical urls, with or without a query, which
+take the fast path, and on urls needing normalization:
+
+    python benchmarks/bench_canonicalize.py
+"""
+
+NUMBER = 100000
+
+URLS = {
+    'canonical': [
+        'http://www.example.com/some/long/path',
+        'https://example.org/a/b/c',
+        'http://ef.me',
+    ],
+    'canonical_query': [
+        'https://www.example.com/search?q=url%20shortener&page=2',
+        'https://example.org/a/b?utm_source=ef&utm_medium=link#top',
+        'http://ef.me/x?id=42',
+    ],
+    'dirty': [
+        'www.Example.com:80/some/path/',
+        'HTTPS://example.org:443/a?b=2&a=1',
+        'http://user@EF.me:8080/x#frag',
+    ],
+}
+
+
+def main():
+    for kind, urls in URLS.items():
+        for func in (clean_url, canonicalize_url,
+                     lambda url: url_hash(canonicalize_url(url))):
+            name = getattr(func, '__name__')
+            if name == '<lambda>':
+                name = 'canonicalize_url+hash'
+            best = min(timeit.repeat(lambda: [func(url) for url in urls],
+                                     number=NUMBER // len(urls), repeat=3))
+            print('{:<16} {:<22} {:6.2f} us/url'.format(
+                kind, name, best / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
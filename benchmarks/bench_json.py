@@ -0,0 +1,73 @@
+import datetime
+import os
+import sys
+import timeit
+
+import hug
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import formats  # noqa: E402
+from helpers import serialize_url  # noqa: E402
+
+"""
+JSON output benchmark
+~~~~~~~~~~~~~~~~~~~~~
+
+Serializes a page of 1000 urls, each with ACCESSES access logs, through
+the previous path (dict building + hug's default json output) and the
+current one (precompiled serializer + orjson output):
+
+    python benchmarks/bench_json.py
+"""
+
+URLS = 1000
+ACCESSES = 20
+ROUNDS = 20
+
+
+def legacy_serialize_url(url):
+    return {
+        'long_url': url['long_url'],
+        'short_url': url['short_url'],
+        'code': url['code'],
+        'url_access': url['url_access'],
+        'total_accesses': len(url['url_access']),
+        'created_at': url['created_at']
+    }
+
+
+def make_urls():
+    now = datetime.datetime.now()
+    return [{
+        'long_url': 'http://www.example.com/some/long/path/{}'.format(i),
+        'short_url': 'http://ef.me/code{}'.format(i),
+        'code': 'code{}'.format(i),
+        'url_access': [
+            {'date': now, 'referrer': 'http://t.co/x', 'user_agent': 'curl'}
+            for _ in range(ACCESSES)
+        ],
+        'created_at': now,
+    } for i in range(URLS)]
+
+
+def legacy(urls):
+    return hug.output_format.json([legacy_serialize_url(url) for url in urls])
+
+
+def current(urls):
+    return formats.json([serialize_url(url, 'http://ef.me') for url in urls])
+
+
+def main():
+    urls = make_urls()
+    results = {}
+    for func in (legacy, current):
+        best = min(timeit.repeat(lambda: func(urls), number=1, repeat=ROUNDS))
+        results[func.__name__] = best
+        print('{:<8} {:8.2f} ms'.format(func.__name__, best * 1000))
+    print('speedup  {:8.1f}x'.format(results['legacy'] / results['current']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,133 @@
+import datetime
+import heapq
 import random
+import re
 import string
 
 from bson.objectid import ObjectId
-from pymongo import MongoClient
-from pymongo.errors import OperationFailure
+from pymongo import MongoClient, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.read_preferences import SecondaryPreferred
 from pymongo.uri_parser import parse_uri
 
+from hashring import HashRing
+
 
 class DB:
     """
     Small wrapper for mongodb collection calls
+
+    When `shard_uris` is given, the urls collection is partitioned across
+    those mongo uris with a consistent hash ring on the url `code`. Entries
+    are `name=uri`, and the ring is keyed on the names, so hosts, passwords
+    or uri options can change without moving codes. Unnamed entries are
+    named after their uri. Code based operations go straight to the owning
+    shard, anything else is scattered over all of them. Users are always
+    kept on `mongo_uri`.
+
+    Reads tagged with one of SECONDARY_READS operation types may be served
+    by secondaries lagging at most `max_staleness` seconds. Creating urls
+    stamps the user `last_write_at`, and reads passing it as `written_at`
+    stay on the primary for that long, whatever the worker serving them. A
+    miss on a secondary is retried on the primary, so a url is readable
+    right after being created. Writes use `write_concern`, or the one in the
+    uri.
     """
     MAX_CODE_LEN = 9
     PAGE_SIZE = 5
+    SECONDARY_READS = ('redirect', 'lookup', 'list', 'stats')
+    # smallest max staleness mongodb accepts
+    MAX_STALENESS = 90
+    SHARD_ENTRY = re.compile(r'^([\w.-]+)=(mongodb(?:\+srv)?://.+)$')
+    # commas starting a new entry, others belong to replica set uris
+    SHARD_SEPARATOR = re.compile(r',(?=\s*(?:[\w.-]+=)?mongodb(?:\+srv)?://)')
 
-    def __init__(self, mongo_uri):
+    def __init__(self, mongo_uri, shard_uris=None, write_concern=None,
+                 max_staleness=MAX_STALENESS):
         parsed_host = parse_uri(mongo_uri)
+        options = {'w': write_concern} if write_concern else {}
 
-        self.conn = MongoClient(mongo_uri)
+        self.conn = MongoClient(mongo_uri, **options)
         self.database = parsed_host['database']
 
-    def create_indexes(self):
+        self.shards = {}
+        for entry in shard_uris or []:
+            name, uri = self.shard_entry(entry)
+            self.shards[name] = (MongoClient(uri, **options),
+                                 parse_uri(uri)['database'])
+        self.ring = HashRing(list(self.shards)) if self.shards else None
+
+        self.secondary = SecondaryPreferred(max_staleness=max_staleness)
+        self.max_staleness = datetime.timedelta(seconds=max_staleness)
+
+    @classmethod
+    def shard_entry(cls, entry):
+        """
+        Returns the (name, uri) of a `name=uri` shard entry
+        """
+        match = cls.SHARD_ENTRY.match(entry)
+        return match.groups() if match else (entry, entry)
+
+    @classmethod
+    def parse_shard_uris(cls, value):
+        """
+        Splits a comma separated list of shard entries, as found in
+        MONGODB_SHARD_URIS
+        """
+        entries = cls.SHARD_SEPARATOR.split(value or '')
+        return [entry.strip() for entry in entries if entry.strip()]
+
+    def mark_written(self, *user_ids):
+        """
+        Stamps the users who just wrote urls. The user document is read from
+        the primary on every authenticated request, so every worker sees it
+        """
+        if not user_ids:
+            return None
+        return self.conn[self.database].users.update_many(
+            {'_id': {'$in': list(user_ids)}},
+            {'$max': {'last_write_at': datetime.datetime.utcnow()}}
+        )
+
+    def for_read(self, collection, read, written_at=None):
+        """
+        Returns `collection` with the read preference of operation `read`.
+        Reads of a user who wrote at `written_at` stay on the primary until
+        secondaries are guaranteed to have caught up
+        """
+        if read not in self.SECONDARY_READS:
+            return collection
+
+        if written_at and \
+                datetime.datetime.utcnow() - written_at < self.max_staleness:
+            return collection
+        return collection.with_options(read_preference=self.secondary)
+
+    def shard_for(self, code):
+        """
+        Returns the name of the shard owning `code`, None if sharding is
+        disabled
+        """
+        if not self.ring:
+            return None
+        return self.ring.get_node(code)
+
+    def url_collection(self, code):
         """
-        adding mongo indexes for quick queries, and secure rules for users
+        Returns the urls collection holding `code`
         """
-        db = self.conn[self.database]
-        # email/api must be unique
-        try:
-            db.users.create_index([('email', 1), ('api_key', 1)], unique=True)
-        except OperationFailure: # pragma: no cover
-            # index already exists
-            pass
+        if not self.ring:
+            return self.conn[self.database].urls
+        conn, database = self.shards[self.shard_for(code)]
+        return conn[database].urls
 
-        # adding index on `code` field
-        try:
-            db.urls.create_index('code', unique=True)
-        except OperationFailure: # pragma: no cover
-            # index already exists
-            pass
+    def url_collections(self):
+        """
+        Returns the urls collection of every shard
+        """
+        if not self.ring:
+            return [self.conn[self.database].urls]
+        return [conn[database].urls for conn, database in self.shards.values()]
 
     @staticmethod
     def sanitize_query(query):
@@ -53,39 +143,156 @@ class DB:
 
         return query
 
-    def find_one_url(self, query, projection=None):
+    def find_one_url(self, query, projection=None, read=None,
+                     written_at=None):
         """
-        wraps pymongo collection.find_one for urls collection
+        wraps pymongo collection.find_one for urls collection. `read` is the
+        operation type and `written_at` the user last write, deciding where
+        the query may be served from
         """
         query = self.sanitize_query(query)
         if not query:
             return None
 
-        res = self.conn[self.database].urls.find_one(query)
-        return res
+        if isinstance(query.get('code'), str):
+            collections = [self.url_collection(query['code'])]
+        else:
+            collections = self.url_collections()
+
+        for urls in collections:
+            res = self.for_read(urls, read, written_at).find_one(query,
+                                                                 projection)
+            # a miss on a secondary may only be replication lag
+            if res is None and read in self.SECONDARY_READS:
+                res = urls.find_one(query, projection)
+            if res:
+                return res
+        return None
 
-    def find_urls(self, user_id, page=1):
+    def find_urls(self, user_id, page=1, read=None, written_at=None):
         """
         Returns a list of user urls, paginated
         """
-        db = self.conn[self.database]
         skip = (page - 1) * self.PAGE_SIZE
-        return db.urls.find(
-            {'created_by': ObjectId(user_id)}
-        ).skip(skip).limit(self.PAGE_SIZE).sort('created_at', -1)
+        query = {'created_by': ObjectId(user_id)}
+        if not self.ring:
+            urls = self.for_read(self.conn[self.database].urls, read,
+                                 written_at)
+            return urls.find(
+                query
+            ).skip(skip).limit(self.PAGE_SIZE).sort('created_at', -1)
+
+        # every shard returns its first skip + PAGE_SIZE urls already sorted,
+        # so merging them is enough to cut the requested page
+        cursors = [
+            self.for_read(urls, read, written_at).find(query).sort(
+                'created_at', -1).limit(skip + self.PAGE_SIZE)
+            for urls in self.url_collections()
+        ]
+        merged = heapq.merge(*cursors, key=lambda url: url['created_at'],
+                             reverse=True)
+        return list(merged)[skip:skip + self.PAGE_SIZE]
+
+    @staticmethod
+    def remove_rollups(urls, codes):
+        """
+        Removes the rollups of `codes` living next to `urls` collection,
+        along with their click events not aggregated yet
+        """
+        if not codes:
+            return None
+        urls.database.url_clicks.delete_many({'code': {'$in': codes}})
+        return urls.database.url_rollups.delete_many({'code': {'$in': codes}})
 
     def insert_url(self, query):
         """
-        wraps pymongo collection.insert_one for urls collection
+        wraps pymongo collection.insert_one for urls collection. Rollups
+        left by a url mongo expired under the same code are removed, so
+        they never show up in the stats of the new one
         """
         query = self.sanitize_query(query)
-        return self.conn[self.database].urls.insert_one(query)
+        urls = self.url_collection(query['code'])
+        result = urls.insert_one(query)
+        self.remove_rollups(urls, [query['code']])
+        if query.get('created_by'):
+            self.mark_written(query['created_by'])
+        return result
 
-    def update_url(self, query, change):
+    def insert_urls(self, urls, duplicates=None):
         """
-        wraps collection.update for urls collection
+        Bulk inserts urls with unordered insert_many calls, one per shard.
+        Urls rejected by the unique code index, or reusing the code of an
+        archived url, are appended to `duplicates`. Like insert_url, stale
+        rollups of the inserted codes are removed. Returns the number of
+        urls inserted
         """
-        return self.conn[self.database].urls.update(query, change)
+        by_shard = {}
+        for url in urls:
+            by_shard.setdefault(self.shard_for(url['code']), []).append(url)
+
+        inserted = 0
+        for batch in by_shard.values():
+            collection = self.url_collection(batch[0]['code'])
+            # codes of archived urls are never reissued
+            archived = set(collection.database.urls_archive.distinct(
+                'code', {'code': {'$in': [url['code'] for url in batch]}}))
+            rejected = [url for url in batch if url['code'] in archived]
+            batch = [url for url in batch if url['code'] not in archived]
+            try:
+                inserted += len(collection.insert_many(
+                    batch, ordered=False).inserted_ids) if batch else 0
+            except BulkWriteError as exc:
+                errors = exc.details['writeErrors']
+                # anything other than a duplicate key is a real failure
+                if any(error['code'] != 11000 for error in errors):
+                    raise
+                inserted += exc.details['nInserted']
+                rejected += [batch[error['index']] for error in errors]
+            if duplicates is not None:
+                duplicates.extend(rejected)
+
+            rejected = set(id(url) for url in rejected)
+            self.remove_rollups(collection, [url['code'] for url in batch
+                                             if id(url) not in rejected])
+
+        self.mark_written(*set(url['created_by'] for url in urls
+                               if url.get('created_by')))
+        return inserted
+
+    def log_access(self, code, access, skip_limited=False, max_clicks=None):
+        """
+        adds an access log entry to the url identified by `code`. Entries
+        are stamped with the time they were logged, `date` being the time of
+        the click, which is in the past for ingested CDN logs. With
+        `skip_limited`, click limited urls, always logged inline, are left
+        alone. With `max_clicks`, the entry is only added while fewer were
+        logged, so concurrent clicks can't go over the limit.
+
+        Every access is also appended to the url_clicks collection read by
+        the aggregation job, stamped by the server clock so events logged by
+        workers with skewed clocks are never missed
+        """
+        query = {'code': code}
+        if skip_limited:
+            query['max_clicks'] = {'$exists': False}
+        if max_clicks:
+            query['url_access.{}'.format(max_clicks - 1)] = {'$exists': False}
+
+        urls = self.url_collection(code)
+        logged_at = datetime.datetime.utcnow()
+        result = urls.update_one(
+            query,
+            {'$push': {'url_access': dict(access, logged_at=logged_at)},
+             '$max': {'updated_at': logged_at}}
+        )
+        if result.matched_count:
+            urls.database.url_clicks.update_one(
+                {'_id': ObjectId()},
+                {'$setOnInsert': dict(access, code=code),
+                 '$currentDate': {'logged_at': True}},
+                upsert=True
+            )
+        return result
 
     def insert_user(self, query):
         """
@@ -101,9 +308,149 @@ class DB:
         query = self.sanitize_query(query)
         return self.conn[self.database].users.find_one(query)
 
+    def expire_url(self, code, date, max_clicks=None):
+        """
+        Sets the expiry date of the url identified by `code`. With
+        `max_clicks`, only once that many clicks were logged
+        """
+        query = {'code': code}
+        if max_clicks:
+            query['url_access.{}'.format(max_clicks - 1)] = {'$exists': True}
+        return self.url_collection(code).update_one(
+            query, {'$set': {'expires_at': date}}
+        )
+
+    def archive_urls(self, query, batch_size=500):
+        """
+        Moves the urls matching `query`, access logs included, to the
+        urls_archive collection of their shard, and removes their rollups as
+        their codes may be reused. Returns the number of urls moved
+        """
+        archived = 0
+        archived_at = datetime.datetime.utcnow()
+        for urls in self.url_collections():
+            archive = urls.database.urls_archive
+            while True:
+                batch = list(urls.find(query).limit(batch_size))
+                if not batch:
+                    break
+
+                # upserts keep a rerun safe if the delete below never ran
+                archive.bulk_write([
+                    ReplaceOne({'_id': url['_id']},
+                               dict(url, archived_at=archived_at),
+                               upsert=True)
+                    for url in batch
+                ], ordered=False)
+                urls.delete_many({'_id': {'$in': [i['_id'] for i in batch]}})
+                self.remove_rollups(urls, [url['code'] for url in batch])
+                archived += len(batch)
+        return archived
+
+    @staticmethod
+    def server_time(urls):
+        """
+        Current time of the server holding `urls` collection, the clock
+        stamping its click events
+        """
+        return urls.database.command('isMaster')['localTime']
+
+    @staticmethod
+    def find_access_events(urls, since, until):
+        """
+        Yields the click events of `urls` collection logged after `since` and
+        up to `until`, by the server clock, whatever the date of the click
+        """
+        logged_at = {'$lte': until}
+        if since:
+            logged_at['$gt'] = since
+
+        return urls.database.url_clicks.find(
+            {'logged_at': logged_at},
+            {'_id': 0, 'code': 1, 'date': 1, 'referrer': 1, 'user_agent': 1}
+        )
+
+    @staticmethod
+    def inc_rollups(urls, counts):
+        """
+        Adds click `counts`, keyed by (code, dimension, key), to the rollups
+        living next to `urls` collection
+        """
+        if not counts:
+            return None
+
+        requests = [
+            UpdateOne({'code': code, 'dimension': dimension, 'key': key},
+                      {'$inc': {'clicks': clicks}}, upsert=True)
+            for (code, dimension, key), clicks in counts.items()
+        ]
+        return urls.database.url_rollups.bulk_write(requests, ordered=False)
+
+    def find_rollups(self, code, dimension, limit, sort=None, read=None):
+        """
+        Returns the rollups of a url for one dimension
+        """
+        rollups = self.for_read(self.url_collection(code).database.url_rollups,
+                                read)
+        cursor = rollups.find({'code': code, 'dimension': dimension},
+                              {'_id': 0, 'key': 1, 'clicks': 1})
+        return cursor.sort(sort or [('key', -1)]).limit(limit)
+
+    def get_schema_version(self):
+        """
+        Returns the version of the last migration applied, 0 if none
+        """
+        schema = self.conn[self.database].schema.find_one({'_id': 'version'})
+        return schema['version'] if schema else 0
+
+    def set_schema_version(self, version):
+        """
+        Saves the version of the last migration applied
+        """
+        return self.conn[self.database].schema.update_one(
+            {'_id': 'version'}, {'$set': {'version': version}}, upsert=True
+        )
+
+    def get_checkpoint(self, name, urls=None):
+        """
+        Returns the last position saved by a background job. Positions of
+        per shard jobs live next to the shard `urls` collection
+        """
+        database = (urls.database if urls is not None
+                    else self.conn[self.database])
+        state = database.job_state.find_one({'_id': name})
+        return state['position'] if state else None
+
+    def set_checkpoint(self, name, position, urls=None):
+        """
+        Saves the position reached by a background job
+        """
+        database = (urls.database if urls is not None
+                    else self.conn[self.database])
+        return database.job_state.update_one(
+            {'_id': name}, {'$set': {'position': position}}, upsert=True
+        )
+
+    def incr_rate_counter(self, key, window_start, window, amount):
+        """
+        Atomically adds `amount` hits to the rate limit counter of `key` for
+        the window starting at `window_start`. Returns the new total
+        """
+        expires_at = datetime.datetime.utcfromtimestamp(window_start + window)
+        counter = self.conn[self.database].rate_limits.find_one_and_update(
+            {'_id': '{}:{}'.format(key, window_start)},
+            {'$inc': {'count': amount},
+             '$setOnInsert': {'expires_at': expires_at}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter['count']
+
     def generate_url_code(self, host):
         """
         Helper method to create a short url code.
+        The code space is hash partitioned, so the uniqueness probe only hits
+        the shard owning the candidate code.
         host + code = 23 chars
         with 54 possible chars (string.ascii_letters)
         9 digit code = 54^9 possibilities
@@ -112,15 +459,29 @@ class DB:
         """
         code = ''.join(random.choice(string.ascii_letters) for i in
                        range(self.MAX_CODE_LEN))
-        exists = self.find_one_url({'code': code})
+        exists = self.code_exists(code)
         while exists:
             code = ''.join(random.choice(string.ascii_letters) for i in
                            range(self.MAX_CODE_LEN))
-            exists = self.find_one_url({'code': code})
+            exists = self.code_exists(code)
         return code
 
+    def code_exists(self, code):
+        """
+        Checks if `code` was ever issued. Dead urls only leave the urls
+        collection through the archive, so their short urls never point
+        somewhere else
+        """
+        urls = self.url_collection(code)
+        return bool(
+            urls.find_one({'code': code}, {'_id': 1}) or
+            urls.database.urls_archive.find_one({'code': code}, {'_id': 1})
+        )
+
     def close(self):
         """
         wraps connection.close() method
         """
+        for conn, _ in self.shards.values():
+            conn.close()
         return self.conn.close()
@@ -0,0 +1,38 @@
+import hug
+from bson.objectid import ObjectId
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+"""
+Output formats
+"""
+
+
+def json_default(obj):
+    """
+    Converts the types orjson does not handle natively
+    """
+    if isinstance(obj, ObjectId):
+        return str(obj)
+
+    if isinstance(obj, (set, frozenset)) or hasattr(obj, '__next__'):
+        # sets, mongo cursors and generators
+        return list(obj)
+
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+
+@hug.format.content_type('application/json; charset=utf-8')
+def json(content, request=None, response=None, **kwargs):
+    """
+    JSON output using orjson, which serializes dicts, lists and datetimes
+    natively in C. Falls back to hug's default json output without it
+    """
+    if orjson is None or hasattr(content, 'read'):  # pragma: no cover
+        return hug.output_format.json(content, request=request,
+                                      response=response, **kwargs)
+
+    return orjson.dumps(content, default=json_default)
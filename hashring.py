@@ -0,0 +1,65 @@
+from bisect import bisect
+import hashlib
+
+"""
+Consistent hash ring used to partition the url code space across shards
+"""
+
+
+class HashRing:
+    """
+    Maps keys (url codes) to nodes (shard mongo uris). Every node is placed
+    `replicas` times on the ring so keys spread evenly, and adding or removing
+    a node only moves the keys that belonged to its neighbours.
+    """
+    REPLICAS = 100
+
+    def __init__(self, nodes=None, replicas=REPLICAS):
+        self.replicas = replicas
+        self._keys = []
+        self._ring = {}
+        self.nodes = []
+        for node in nodes or []:
+            self.add_node(node)
+
+    @staticmethod
+    def hash(key):
+        """
+        Stable 64 bit position for a key. md5 is used for its spread, not
+        for security
+        """
+        digest = hashlib.md5(str(key).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def add_node(self, node):
+        """
+        Adds a node with all its virtual points to the ring
+        """
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for i in range(self.replicas):
+            point = self.hash('{}#{}'.format(node, i))
+            self._ring[point] = node
+        self._keys = sorted(self._ring)
+
+    def remove_node(self, node):
+        """
+        Removes a node and its virtual points from the ring
+        """
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        for i in range(self.replicas):
+            self._ring.pop(self.hash('{}#{}'.format(node, i)), None)
+        self._keys = sorted(self._ring)
+
+    def get_node(self, key):
+        """
+        Returns the node owning `key`
+        """
+        if not self._keys:
+            raise ValueError('Hash ring has no nodes')
+
+        idx = bisect(self._keys, self.hash(key)) % len(self._keys)
+        return self._ring[self._keys[idx]]
@@ -1,7 +1,13 @@
-from urllib.parse import urlparse
+from urllib.parse import parse_qsl, urlencode, urlparse, urlsplit, urlunsplit
 from email.utils import parseaddr
+from operator import itemgetter
+import datetime
 import hashlib
-import os
+import hmac
+import re
+import secrets
+
+from bson.binary import Binary
 
 """
 Helper methods
@@ -15,7 +21,7 @@ def clean_url(url):
     if type(url) != str:
         raise ValueError('URL must be a string')
 
-    if not url.startswith(('http://', 'https://')):
+    if not url[:8].lower().startswith(('http://', 'https://')):
         url = 'http://{}'.format(url)
 
     parsed = urlparse(url)
@@ -31,6 +37,103 @@ def clean_url(url):
     return url
 
 
+# characters of a short url code that /s/{code} routes, without slashes or
+# whitespace
+CODE_CHARS = r'[A-Za-z0-9_-]'
+VALID_CODE = re.compile(r'^{}+\Z'.format(CODE_CHARS))
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+# urls already canonical: lowercase host, no port or userinfo, no empty
+# query or fragment, no whitespace or trailing slash. They skip parsing
+CANONICAL_URL = re.compile(
+    r'^https?://[a-z0-9.-]+(?:/[^\s?#]*)?(?:\?[^\s#]+)?(?:#\S+)?(?<!/)\Z'
+)
+
+
+def canonicalize_url(url, sort_query=False):
+    """
+    Canonical form of a url, for storage and dedup. Validates and cleans like
+    clean_url, parsing the url once, then lowercases the scheme and host and
+    strips default ports and trailing slashes. With `sort_query`, query
+    params are sorted too
+    """
+    if type(url) != str:
+        raise ValueError('URL must be a string')
+
+    if CANONICAL_URL.match(url) and not (sort_query and '?' in url):
+        return url
+
+    # same cleaning as clean_url, in the same order
+    if not url[:8].lower().startswith(('http://', 'https://')):
+        url = 'http://{}'.format(url)
+    url = url.replace(' ', '')
+    if url.endswith('/'):
+        url = url[:-1]
+
+    parsed = urlsplit(url)
+    if not parsed.netloc:
+        raise ValueError('URL is not valid')
+    scheme = parsed.scheme
+
+    userinfo, _, hostport = parsed.netloc.rpartition('@')
+    if hostport.startswith('['):
+        # ipv6 literal
+        host, _, port = hostport[1:].partition(']')
+        host = '[{}]'.format(host)
+        port = port[1:]
+    else:
+        host, _, port = hostport.partition(':')
+
+    if port and (not port.isdigit() or int(port) > 65535):
+        raise ValueError('URL port is not valid')
+    if not host:
+        raise ValueError('URL is not valid')
+
+    netloc = host.lower()
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = '{}:{}'.format(netloc, port)
+    if userinfo:
+        netloc = '{}@{}'.format(userinfo, netloc)
+
+    # trailing slashes are dropped, with the parts they leave empty
+    path, query, fragment = parsed.path, parsed.query, parsed.fragment
+    fragment = fragment.rstrip('/')
+    if not fragment:
+        query = query.rstrip('/')
+    if not fragment and not query:
+        path = path.rstrip('/')
+    if sort_query and query:
+        query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def url_hash(url):
+    """
+    Fixed size hash of a canonical url, indexed per user for dedup instead
+    of the url itself
+    """
+    return Binary(hashlib.sha256(url.encode('utf-8')).digest()[:16])
+
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+def parse_datetime(value):
+    """
+    Parses an ISO 8601 date or datetime without timezone
+    """
+    if type(value) != str:
+        raise ValueError('Date must be a string')
+
+    for date_format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError('Date is not valid')
+
+
 def clean_email(email):
     """
     Small helper function to check if email is valid
@@ -58,23 +161,178 @@ def hash_password(email, salt):
     return hashlib.sha512(password + salt).hexdigest()
 
 
-def gen_api_key(email):  # pragma: no cover
+API_KEY_PREFIX_LEN = 12
+
+
+def gen_api_key():  # pragma: no cover
     """
-    Create a random API key for a user
+    Create a random API key for a user: `<public prefix>.<secret>`
     """
-    salt = str(os.urandom(64)).encode('utf-8')
-    return hash_password(email, salt)
+    prefix = secrets.token_hex(API_KEY_PREFIX_LEN // 2)
+    return '{}.{}'.format(prefix, secrets.token_urlsafe(32))
 
 
-def serialize_url(url):
+def split_api_key(api_key):
     """
-    Serialize url for output
+    Splits an API key into its lookup prefix and its secret. Keys created
+    before prefixed keys existed are their own secret, their first chars
+    being the prefix
+    """
+    if type(api_key) != str or not api_key:
+        raise ValueError('API key must be a non empty string')
+
+    if '.' in api_key:
+        prefix, secret = api_key.split('.', 1)
+    else:
+        prefix, secret = api_key[:API_KEY_PREFIX_LEN], api_key
+
+    if not prefix or not secret:
+        raise ValueError('API key is not valid')
+    return prefix, secret
+
+
+def hash_api_secret(secret):
     """
+    Raw SHA256 digest of an API key secret
+    """
+    return hashlib.sha256(secret.encode('utf-8')).digest()
+
+
+def api_key_fields(api_key):
+    """
+    User fields storing an API key: the indexed prefix and the secret hash
+    """
+    prefix, secret = split_api_key(api_key)
     return {
-        'long_url': url['long_url'],
-        'short_url': url['short_url'],
-        'code': url['code'],
-        'url_access': url['url_access'],
-        'total_accesses': len(url['url_access']),
-        'created_at': url['created_at']
+        'api_key_prefix': prefix,
+        'api_key_hash': Binary(hash_api_secret(secret)),
     }
+
+
+def check_api_key(user, secret):
+    """
+    Constant time check of an API key secret against a user
+    """
+    return hmac.compare_digest(hash_api_secret(secret),
+                               bytes(user['api_key_hash']))
+
+
+def url_expired(url, now):
+    """
+    Checks if a url is past its expiry date or click limit
+    """
+    if url.get('expires_at') and url['expires_at'] <= now:
+        return True
+
+    max_clicks = url.get('max_clicks')
+    return bool(max_clicks) and len(url['url_access']) >= max_clicks
+
+
+MAX_AGE = re.compile(r'\b(max-age|s-maxage)=(\d+)')
+
+
+def redirect_cache_control(url, cache_control, now):
+    """
+    Cache-Control for a url redirect, `cache_control` being the configured
+    policy, if any. Cache lifetimes are capped to what is left before the
+    url expires, and click limited urls are never cached so every click is
+    counted. Both apply without a policy too, as browsers keep a bare 301
+    forever
+    """
+    if url.get('max_clicks'):
+        return 'no-store'
+
+    if not url.get('expires_at'):
+        return cache_control
+
+    remaining = max(int((url['expires_at'] - now).total_seconds()), 0)
+    max_age = 'max-age={}'.format(remaining)
+    if not cache_control:
+        return max_age
+    if not MAX_AGE.search(cache_control):
+        return '{}, {}'.format(cache_control, max_age)
+    return MAX_AGE.sub(
+        lambda m: '{}={}'.format(m.group(1), min(int(m.group(2)), remaining)),
+        cache_control
+    )
+
+
+def url_etag(url, variant=''):
+    """
+    Strong ETag for a url document, changing every time `updated_at` does.
+    `variant` tells apart the representations served for the same url
+    """
+    updated_at = url.get('updated_at') or url['created_at']
+    raw = '{}:{}:{}'.format(url['_id'], updated_at.isoformat(), variant)
+    return '"{}"'.format(hashlib.sha1(raw.encode('utf-8')).hexdigest())
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Checks an If-None-Match header value against `etag`
+    """
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == '*':
+        return True
+
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in tags or 'W/{}'.format(etag) in tags
+
+
+def field_serializer(fields, computed=()):
+    """
+    Precompiles a serializer projecting `fields` as they are, plus
+    `computed` (name, function) pairs applied to the whole document. Values
+    are left untouched, datetimes and lists are handled by the output format
+    """
+    getters = tuple((name, itemgetter(name)) for name in fields)
+    getters += tuple(computed)
+
+    def serialize(doc):
+        return {name: getter(doc) for name, getter in getters}
+
+    return serialize
+
+
+def short_url_for(host, code):
+    """
+    Short url of a code. It is derived on output, never stored
+    """
+    return '{}/{}'.format(host, code)
+
+
+def short_url_code(short_url, host):
+    """
+    Extracts the code out of a short url made for `host`. Returns None when
+    the url does not belong to `host`
+    """
+    parsed = urlparse(short_url)
+    base = urlparse(host)
+    if parsed.netloc.lower() != base.netloc.lower():
+        return None
+
+    prefix = '{}/'.format(base.path.rstrip('/'))
+    if not parsed.path.startswith(prefix):
+        return None
+
+    code = parsed.path[len(prefix):]
+    if not code or '/' in code:
+        return None
+    return code
+
+
+_serialize_url = field_serializer(
+    ('long_url', 'code', 'url_access', 'created_at'),
+    computed=(('total_accesses', lambda url: len(url['url_access'])),),
+)
+
+
+def serialize_url(url, host):
+    """
+    Serialize url for output
+    """
+    serialized = _serialize_url(url)
+    serialized['short_url'] = short_url_for(host, url['code'])
+    return serialized
@@ -0,0 +1,236 @@
+import argparse
+import csv
+import datetime
+from itertools import islice
+import json
+from multiprocessing import Pool
+import os
+import sys
+import time
+
+from bson.objectid import ObjectId
+
+from db import DB
+from helpers import VALID_CODE, canonicalize_url, parse_datetime, url_hash
+
+"""
+Bulk url importer
+~~~~~~~~~~~~~~~~~
+
+Imports links from another shortener, keeping their codes. Input is CSV with
+a header or NDJSON, one link per row:
+
+    long_url  - url to redirect to
+    code      - original short url code: up to 9 letters, digits, _ or -
+    created_at - (optional) ISO 8601 creation date, in UTC
+
+    python importer.py links.csv --email owner@email.com
+    python importer.py links.ndjson --email owner@email.com --workers 8
+
+Rows are streamed and validated in a process pool, then written in
+unordered batches. Codes already taken are reported as collisions. Invalid
+rows and collisions are written to the --rejects file.
+
+Progress is checkpointed to `<input>.checkpoint` after each batch, and a new
+run on the same input resumes after the last written batch. Rows of a batch
+written right before a crash show up as collisions on resume.
+"""
+
+BATCH_SIZE = 1000
+WORKERS = os.cpu_count() or 1
+
+
+def read_rows(path, input_format):
+    """
+    Streams the input rows as dicts, None for unreadable ones
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        if input_format == 'csv':
+            for row in csv.DictReader(f):
+                yield row
+            return
+
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield row if isinstance(row, dict) else None
+
+
+def validate_rows(rows):
+    """
+    Validates and converts a chunk of (row number, row) pairs into url
+    documents. Runs in the pool workers. Returns ((row number, url) pairs,
+    rejects)
+    """
+    urls = []
+    rejects = []
+    for number, row in rows:
+        if row is None:
+            rejects.append({'row': number, 'error': 'row is not valid'})
+            continue
+
+        try:
+            long_url = canonicalize_url(row.get('long_url'))
+        except ValueError:
+            rejects.append({'row': number, 'error': 'long_url is not valid'})
+            continue
+
+        # codes must be routable by /s/{code}
+        code = row.get('code')
+        if type(code) != str or len(code) > DB.MAX_CODE_LEN or \
+                not VALID_CODE.match(code):
+            rejects.append({'row': number, 'error': 'code is not valid'})
+            continue
+
+        created_at = row.get('created_at')
+        try:
+            created_at = (parse_datetime(created_at) if created_at
+                          else datetime.datetime.utcnow())
+        except ValueError:
+            rejects.append({'row': number,
+                            'error': 'created_at is not valid'})
+            continue
+
+        urls.append((number, {
+            'long_url': long_url,
+            'long_url_hash': url_hash(long_url),
+            'code': code,
+            'url_access': [],
+            'created_at': created_at,
+            'updated_at': created_at,
+        }))
+    return urls, rejects
+
+
+def chunks(rows, start, size):
+    """
+    Groups numbered rows in chunks of `size`, skipping the first `start`
+    """
+    numbered = enumerate(rows, 1)
+    for _ in islice(numbered, start):
+        pass
+    while True:
+        chunk = list(islice(numbered, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {'row': 0, 'inserted': 0, 'collisions': 0, 'invalid': 0}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    # write and rename, so a crash never leaves a truncated checkpoint
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def run_import(db, path, owner_id, input_format='csv', batch_size=BATCH_SIZE,
+               workers=WORKERS, rejects_file=None, out=sys.stderr):
+    """
+    Imports `path` for user `owner_id`. Returns the final checkpoint
+    """
+    checkpoint_path = '{}.checkpoint'.format(path)
+    checkpoint = load_checkpoint(checkpoint_path)
+    started = time.time()
+    processed = 0
+    owner_id = ObjectId(owner_id)
+
+    rows = chunks(read_rows(path, input_format), checkpoint['row'],
+                  batch_size)
+    with Pool(workers) as pool:
+        for chunk, (numbered, rejects) in validated_chunks(rows, pool,
+                                                           workers * 2):
+            urls = []
+            numbers = {}
+            for number, url in numbered:
+                url['created_by'] = owner_id
+                urls.append(url)
+                numbers[id(url)] = number
+
+            duplicates = []
+            checkpoint['inserted'] += db.insert_urls(urls, duplicates)
+            checkpoint['collisions'] += len(duplicates)
+            checkpoint['invalid'] += len(rejects)
+            if rejects_file:
+                rejects += [{'row': numbers[id(url)],
+                             'error': 'code already exists'}
+                            for url in duplicates]
+                for reject in rejects:
+                    rejects_file.write(json.dumps(reject) + '\n')
+
+            checkpoint['row'] = chunk[-1][0]
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            processed += len(chunk)
+            elapsed = time.time() - started
+            out.write('row={row} inserted={inserted} collisions={collisions} '
+                      'invalid={invalid} rate={rate:.0f} rows/s\n'.format(
+                          rate=processed / elapsed if elapsed else 0,
+                          **checkpoint))
+    return checkpoint
+
+
+def validated_chunks(rows, pool, window):
+    """
+    Pairs chunks of rows with their validation result, validating `window`
+    chunks at a time in the pool so memory stays bounded. Order is kept,
+    so checkpoints stay contiguous
+    """
+    while True:
+        pending = list(islice(rows, window))
+        if not pending:
+            return
+        for chunk, result in zip(pending, pool.map(validate_rows, pending)):
+            yield chunk, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk url importer')
+    parser.add_argument('path', help='CSV or NDJSON file')
+    parser.add_argument('--email', required=True,
+                        help='email of the user owning the imported urls')
+    parser.add_argument('--format', choices=('csv', 'ndjson'),
+                        help='input format, guessed from the extension')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--rejects', help='file receiving rejected rows')
+    args = parser.parse_args()
+
+    input_format = args.format or (
+        'ndjson' if args.path.endswith(('.ndjson', '.jsonl')) else 'csv')
+
+    shard_uris = DB.parse_shard_uris(os.environ.get('MONGODB_SHARD_URIS'))
+    db = DB(os.environ.get('MONGODB_URI'), shard_uris=shard_uris)
+    rejects_file = open(args.rejects, 'a') if args.rejects else None
+    try:
+        owner = db.find_one_user({'email': args.email})
+        if not owner:
+            sys.exit('User {} does not exist'.format(args.email))
+
+        checkpoint = run_import(db, args.path, owner['_id'], input_format,
+                                batch_size=args.batch_size,
+                                workers=args.workers,
+                                rejects_file=rejects_file)
+    finally:
+        db.close()
+        if rejects_file:
+            rejects_file.close()
+
+    print('inserted={inserted} collisions={collisions} '
+          'invalid={invalid}'.format(**checkpoint))
+
+
+if __name__ == '__main__':
+    main()
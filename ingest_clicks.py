@@ -0,0 +1,85 @@
+import argparse
+import datetime
+import fileinput
+import os
+import re
+
+from db import DB
+from helpers import CODE_CHARS
+
+"""
+CDN access log ingestion
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Counts clicks from redirects served by a CDN, for CLICK_TRACKING=log.
+Reads access logs in the common or combined log format:
+
+    python ingest_clicks.py cdn-access.log ...
+    zcat cdn-access.log.gz | python ingest_clicks.py
+"""
+
+LOG_LINE = re.compile(
+    r'\[(?P<date>[^\]]+)\] "(?:GET|HEAD) /s/(?P<code>' + CODE_CHARS + r'+)'
+    r'[^"]*" (?P<status>\d{3})'
+    r'(?: \S+ "(?P<referrer>[^"]*)" "(?P<user_agent>[^"]*)")?'
+)
+LOG_DATE_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
+
+
+def parse_line(line):
+    """
+    Returns (code, access log) for a redirect hit, None for any other line.
+    Dates are converted to naive UTC, like every date stored by the api
+    """
+    match = LOG_LINE.search(line)
+    if not match or match.group('status') not in ('301', '304'):
+        return None
+
+    try:
+        date = datetime.datetime.strptime(match.group('date'),
+                                          LOG_DATE_FORMAT)
+    except ValueError:
+        return None
+
+    date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    access = {'date': date}
+    # combined log format, `-` stands for a missing header
+    for field in ('referrer', 'user_agent'):
+        value = match.group(field)
+        access[field] = value if value and value != '-' else None
+    return match.group('code'), access
+
+
+def ingest(db, lines):
+    """
+    Logs every redirect hit found in `lines`. Click limited urls are skipped,
+    the api already counted them. Returns the number of clicks logged
+    """
+    clicks = 0
+    for line in lines:
+        hit = parse_line(line)
+        if not hit:
+            continue
+
+        code, access = hit
+        result = db.log_access(code, access, skip_limited=True)
+        clicks += result.matched_count
+    return clicks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CDN access log ingestion')
+    parser.add_argument('files', nargs='*', help='log files, default stdin')
+    args = parser.parse_args()
+
+    shard_uris = DB.parse_shard_uris(os.environ.get('MONGODB_SHARD_URIS'))
+    db = DB(os.environ.get('MONGODB_URI'), shard_uris=shard_uris)
+    try:
+        clicks = ingest(db, fileinput.input(args.files))
+    finally:
+        db.close()
+    print('clicks={}'.format(clicks))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,12 @@
+import atexit
+import hashlib
 import os
 
+from falcon import HTTPError, HTTP_429
+
 from db import DB
+from migrations import SCHEMA_VERSION
+from ratelimit import MongoCounterStore, RateLimiter, retry_after_header
 
 
 class HostEnvMiddleware:
@@ -18,12 +24,96 @@ class HostEnvMiddleware:
 class MongoMiddleware:
     def __init__(self, **kwargs):
         mongo_uri = os.environ.get('MONGODB_URI')
-        self.db = DB(mongo_uri)
-        self.db.create_indexes()
+        # optional comma separated list of `name=uri` shards of the urls
+        shard_uris = DB.parse_shard_uris(os.environ.get('MONGODB_SHARD_URIS'))
+        # optional write concern, eg. `majority` or a number of members
+        write_concern = os.environ.get('MONGODB_WRITE_CONCERN')
+        if write_concern and write_concern.isdigit():
+            write_concern = int(write_concern)
+        max_staleness = int(os.environ.get('MONGODB_MAX_STALENESS',
+                                           DB.MAX_STALENESS))
+        self.db = DB(mongo_uri, shard_uris=shard_uris,
+                     write_concern=write_concern, max_staleness=max_staleness)
+
+        # indexes and data migrations are owned by `python migrations.py`,
+        # workers only make sure it ran
+        version = self.db.get_schema_version()
+        if version < SCHEMA_VERSION:
+            raise Exception('Database schema version {} is behind {}, run '
+                            '`python migrations.py`'.format(version,
+                                                            SCHEMA_VERSION))
+
+        # connection pools, one per shard plus the main one, live as long as
+        # the worker
+        atexit.register(self.db.close)
 
     def process_request(self, request, response):
         request.context['db'] = self.db
 
     def process_response(self, request, response, resource):
-        self.db.close()
         request.context['db'] = None
+
+
+class RateLimitMiddleware:
+    """
+    Per api key and per client ip token buckets for the /api/ routes.
+    Set RATE_LIMIT_SHARED to also sync the counters through mongodb, so the
+    limits hold across workers. Behind proxies, set TRUSTED_PROXIES to the
+    number of hops in front of the app (1 on heroku) so clients are told
+    apart by X-Forwarded-For instead of the proxy address
+    """
+    KEY_RATE = 10
+    KEY_BURST = 100
+    IP_RATE = 20
+    IP_BURST = 200
+    PREFIX = '/api/'
+
+    def __init__(self, key_rate=KEY_RATE, key_burst=KEY_BURST,
+                 ip_rate=IP_RATE, ip_burst=IP_BURST, store=None,
+                 trusted_proxies=None, **kwargs):
+        if trusted_proxies is None:
+            trusted_proxies = int(os.environ.get('TRUSTED_PROXIES', 0))
+        self.trusted_proxies = trusted_proxies
+
+        if store is None and os.environ.get('RATE_LIMIT_SHARED'):
+            store = MongoCounterStore(DB(os.environ.get('MONGODB_URI')))
+
+        self.key_limiter = RateLimiter(key_rate, key_burst, store=store,
+                                       **kwargs)
+        self.ip_limiter = RateLimiter(ip_rate, ip_burst, store=store,
+                                      **kwargs)
+
+    def client_ip(self, request):
+        """
+        The address the last trusted proxy saw the request coming from.
+        Entries before it in X-Forwarded-For are set by the client and can't
+        be trusted
+        """
+        route = [request.remote_addr]
+        if self.trusted_proxies:
+            forwarded = request.get_header('X-Forwarded-For') or ''
+            route = [ip.strip() for ip in forwarded.split(',')
+                     if ip.strip()] + route
+        return route[-min(self.trusted_proxies + 1, len(route))]
+
+    def process_request(self, request, response):
+        if not request.path.startswith(self.PREFIX):
+            return
+
+        retry_after = self.ip_limiter.hit(
+            'ip:{}'.format(self.client_ip(request)))
+
+        # keys are limited by a hash of the whole key: the prefix alone is
+        # public, and anyone could drain the bucket of a key knowing it
+        api_key = request.get_header('X-Api-Key')
+        if api_key and not retry_after:
+            digest = hashlib.blake2b(api_key.encode('utf-8'),
+                                     digest_size=16).hexdigest()
+            retry_after = self.key_limiter.hit('key:{}'.format(digest))
+
+        if retry_after:
+            raise HTTPError(HTTP_429, 'Too Many Requests',
+                            'Rate limit exceeded, retry later',
+                            headers={
+                                'Retry-After': retry_after_header(retry_after)
+                            })
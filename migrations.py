@@ -0,0 +1,339 @@
+import argparse
+import datetime
+import os
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from aggregate import CHECKPOINT
+from db import DB
+from helpers import api_key_fields, canonicalize_url, url_hash
+
+"""
+Schema migrations
+~~~~~~~~~~~~~~~~~
+
+Versioned index builds and data migrations. They run once, from this
+command, instead of on every worker boot; workers only check the database
+schema version is at least SCHEMA_VERSION:
+
+    python migrations.py              # migrate to the latest version
+    python migrations.py --list       # show migrations and current version
+    python migrations.py --target 2   # migrate up to version 2
+
+New migrations are appended to MIGRATIONS with the next version number.
+Index specs are frozen with the migration building them: adding or changing
+an index takes a new migration.
+"""
+
+# collections living on every url shard
+SHARDED = ('urls', 'urls_archive', 'url_rollups', 'url_clicks')
+
+# (collection, keys, options) built by migration 1
+INDEXES_V1 = (
+    # email must be unique
+    ('users', 'email', {'unique': True}),
+    # api keys are looked up by their public prefix. Sparse, as users not
+    # migrated yet have no prefix
+    ('users', 'api_key_prefix', {'unique': True, 'sparse': True}),
+    # shared rate limit counters are dropped once their window is over
+    ('rate_limits', 'expires_at', {'expireAfterSeconds': 0}),
+    ('urls', 'code', {'unique': True}),
+    # TTL removing expired urls after a 7 days grace, dropped by migration 7
+    ('urls', 'expires_at', {'expireAfterSeconds': 7 * 24 * 60 * 60}),
+    # lets the click aggregation only visit recently clicked urls
+    ('urls', 'updated_at', {}),
+    # one rollup document per url, dimension and bucket
+    ('url_rollups', [('code', 1), ('dimension', 1), ('key', 1)],
+     {'unique': True}),
+)
+
+# built by migration 4: per user dedup of long urls, on a fixed size hash
+INDEXES_V4 = (
+    ('urls', [('created_by', 1), ('long_url_hash', 1)], {}),
+)
+
+# built by migration 6: click events read by the aggregation job, in the
+# order the server logged them, removed after a month
+INDEXES_V6 = (
+    ('url_clicks', 'logged_at', {'expireAfterSeconds': 30 * 24 * 60 * 60}),
+)
+
+# built by migration 7: expired urls stay until archived, and codes are
+# looked up in the archive so they are never reissued
+INDEXES_V7 = (
+    ('urls', 'expires_at', {}),
+    ('urls_archive', 'code', {}),
+)
+
+
+def collection_sizes(collection):
+    """
+    Data and index sizes of a collection, in bytes
+    """
+    stats = collection.database.command('collStats', collection.name)
+    return {'size': stats['size'], 'index_size': stats['totalIndexSize']}
+
+
+def build_indexes(db, indexes):
+    """
+    Builds `indexes` specs, on every shard for sharded collections. Builds
+    are idempotent, and failures, like duplicate keys under a unique index,
+    are raised so the migration is not recorded as applied
+    """
+    main = db.conn[db.database]
+    shards = [urls.database for urls in db.url_collections()]
+    for collection, keys, options in indexes:
+        for database in (shards if collection in SHARDED else [main]):
+            database[collection].create_index(keys, **options)
+
+
+def create_indexes(db):
+    """
+    Builds the indexes the api relied on when migrations were introduced
+    """
+    build_indexes(db, INDEXES_V1)
+    return []
+
+
+def drop_short_url(db):
+    """
+    short_url is derived from the code on output, so the stored copy and
+    any index on it are dropped. Returns the size savings per collection
+    """
+    report = []
+    for urls in db.url_collections():
+        before = collection_sizes(urls)
+        urls.update_many({'short_url': {'$exists': True}},
+                         {'$unset': {'short_url': ''}})
+        for name, index in urls.index_information().items():
+            if index['key'][0][0] == 'short_url':
+                urls.drop_index(name)
+        after = collection_sizes(urls)
+
+        report.append({
+            'collection': urls.full_name,
+            'size_saved': before['size'] - after['size'],
+            'index_size_saved': before['index_size'] - after['index_size'],
+        })
+    return report
+
+
+def rekey_api_keys(db):
+    """
+    Replaces plain text api keys by their prefix and secret hash. Existing
+    keys keep working, and the index on the plain key is dropped. Returns
+    the size savings of the users collection
+    """
+    users = db.conn[db.database].users
+    before = collection_sizes(users)
+    for user in users.find({'api_key': {'$exists': True}},
+                           {'api_key': 1}):
+        users.update_one({'_id': user['_id']}, {
+            '$set': api_key_fields(user['api_key']),
+            '$unset': {'api_key': ''},
+        })
+
+    for name, index in users.index_information().items():
+        if 'api_key' in [key for key, _ in index['key']]:
+            users.drop_index(name)
+    after = collection_sizes(users)
+
+    return [{
+        'collection': users.full_name,
+        'size_saved': before['size'] - after['size'],
+        'index_size_saved': before['index_size'] - after['index_size'],
+    }]
+
+
+def hash_long_urls(db, batch_size=1000):
+    """
+    Backfills long_url_hash, the dedup key of long urls, and builds its
+    index. Stored long urls are left as they are
+    """
+    build_indexes(db, INDEXES_V4)
+    for urls in db.url_collections():
+        missing = urls.find({'long_url_hash': {'$exists': False}},
+                            {'long_url': 1})
+        batch = []
+        for url in missing:
+            try:
+                long_url = canonicalize_url(url['long_url'])
+            except ValueError:
+                long_url = url['long_url']
+            batch.append(UpdateOne(
+                {'_id': url['_id']},
+                {'$set': {'long_url_hash': url_hash(long_url)}}
+            ))
+            if len(batch) == batch_size:
+                urls.bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            urls.bulk_write(batch, ordered=False)
+    return []
+
+
+def utc_dates(db, offset=None, batch_size=1000):
+    """
+    Moves the creation and click dates written by the local time release to
+    UTC. `offset` is the timezone its servers ran in, in minutes east of
+    UTC, from LEGACY_UTC_OFFSET; heroku dynos run in UTC, so by default
+    dates are left as they are. Clicks logged since carry logged_at and are
+    not moved
+    """
+    if offset is None:
+        offset = int(os.environ.get('LEGACY_UTC_OFFSET', 0))
+    offset = datetime.timedelta(minutes=offset)
+    if not offset:
+        return []
+
+    main = db.conn[db.database]
+    collections = [main.users]
+    for urls in db.url_collections():
+        collections += [urls, urls.database.urls_archive]
+
+    for collection in collections:
+        batch = []
+        for doc in collection.find({}, {'created_at': 1, 'url_access': 1}):
+            fields = {}
+            if doc.get('created_at'):
+                fields['created_at'] = doc['created_at'] - offset
+            if doc.get('url_access'):
+                fields['url_access'] = [
+                    access if 'logged_at' in access
+                    else dict(access, date=access['date'] - offset)
+                    for access in doc['url_access']
+                ]
+            if not fields:
+                continue
+
+            batch.append(UpdateOne({'_id': doc['_id']}, {'$set': fields}))
+            if len(batch) == batch_size:
+                collection.bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            collection.bulk_write(batch, ordered=False)
+    return []
+
+
+def click_events(db, batch_size=1000):
+    """
+    Builds the url_clicks collections the aggregation job reads instead of
+    the url_access arrays, and copies in the accesses it did not fold yet.
+    They are stamped as logged now, after the last checkpoint
+    """
+    build_indexes(db, INDEXES_V6)
+    last_run = db.get_checkpoint(CHECKPOINT)
+    for urls in db.url_collections():
+        since = db.get_checkpoint(CHECKPOINT, urls) or last_run
+        pipeline = [
+            {'$unwind': '$url_access'},
+            {'$project': {
+                '_id': 0,
+                'code': 1,
+                'date': '$url_access.date',
+                'referrer': '$url_access.referrer',
+                'user_agent': '$url_access.user_agent',
+                # entries logged before logged_at existed only have a date
+                'logged_at': {'$ifNull': ['$url_access.logged_at',
+                                          '$url_access.date']},
+            }},
+        ]
+        if since:
+            pipeline.insert(0, {'$match': {'updated_at': {'$gt': since}}})
+            pipeline.append({'$match': {'logged_at': {'$gt': since}}})
+
+        clicks = urls.database.url_clicks
+        batch = []
+        for event in urls.aggregate(pipeline):
+            del event['logged_at']
+            batch.append(UpdateOne(
+                {'_id': ObjectId()},
+                {'$setOnInsert': event, '$currentDate': {'logged_at': True}},
+                upsert=True
+            ))
+            if len(batch) == batch_size:
+                clicks.bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            clicks.bulk_write(batch, ordered=False)
+    return []
+
+
+def drop_urls_ttl(db):
+    """
+    Replaces the TTL index removing expired urls by a plain one. Urls mongo
+    removed took their code with them, and it could be issued again; dead
+    urls now only leave through the archive, which keeps their code
+    """
+    for urls in db.url_collections():
+        for name, index in urls.index_information().items():
+            if index['key'][0][0] == 'expires_at' and \
+                    'expireAfterSeconds' in index:
+                urls.drop_index(name)
+    build_indexes(db, INDEXES_V7)
+    return []
+
+
+MIGRATIONS = [
+    (1, 'create_indexes', create_indexes),
+    (2, 'drop_short_url', drop_short_url),
+    (3, 'rekey_api_keys', rekey_api_keys),
+    (4, 'hash_long_urls', hash_long_urls),
+    (5, 'utc_dates', utc_dates),
+    (6, 'click_events', click_events),
+    (7, 'drop_urls_ttl', drop_urls_ttl),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(db, target=SCHEMA_VERSION, out=print):
+    """
+    Runs the migrations after the database schema version, up to `target`.
+    The version is saved after each one, so a failed run resumes where it
+    stopped. Returns the versions applied
+    """
+    current = db.get_schema_version()
+    applied = []
+    for version, name, migration in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+
+        out('applying {} {}'.format(version, name))
+        for line in migration(db):
+            out('  {collection}: size_saved={size_saved} '
+                'index_size_saved={index_size_saved}'.format(**line))
+        db.set_schema_version(version)
+        applied.append(version)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Schema migrations')
+    parser.add_argument('--target', type=int, default=SCHEMA_VERSION,
+                        help='version to migrate to, default latest')
+    parser.add_argument('--list', action='store_true',
+                        help='list migrations and exit')
+    args = parser.parse_args()
+
+    shard_uris = DB.parse_shard_uris(os.environ.get('MONGODB_SHARD_URIS'))
+    db = DB(os.environ.get('MONGODB_URI'), shard_uris=shard_uris)
+    try:
+        if args.list:
+            current = db.get_schema_version()
+            for version, name, _ in MIGRATIONS:
+                status = 'applied' if version <= current else 'pending'
+                print('{} {} {}'.format(version, name, status))
+            return
+
+        applied = migrate(db, target=args.target)
+        print('schema version {}'.format(db.get_schema_version()))
+        if not applied:
+            print('nothing to migrate')
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+import math
+import time
+
+"""
+Token bucket rate limiting
+"""
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens are added per second, up to `burst`
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def consume(self, now, amount=1):
+        """
+        Takes `amount` tokens. Returns 0 when allowed, otherwise the seconds
+        to wait until enough tokens are available
+        """
+        elapsed = max(now - self.updated_at, 0)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0
+        return (amount - self.tokens) / self.rate
+
+
+class MongoCounterStore:
+    """
+    Shared counter store backed by the DB wrapper, so every worker sees the
+    same per window totals
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def incr(self, key, window_start, window, amount):
+        return self.db.incr_rate_counter(key, window_start, window, amount)
+
+
+class RateLimiter:
+    """
+    In-process token buckets per key, with an optional shared store.
+
+    The local bucket is always the fast path. When a store is given, hits are
+    batched and pushed every `sync_every` requests per key; if the shared
+    total for the current `window` goes over what the bucket allows, the key
+    is blocked until the window ends.
+    """
+    MAX_KEYS = 10000
+
+    def __init__(self, rate, burst, store=None, window=60, sync_every=10,
+                 clock=time.time, max_keys=MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.store = store
+        self.window = window
+        self.sync_every = sync_every
+        self.clock = clock
+        self.max_keys = max_keys
+        self.window_limit = rate * window + burst
+        self.buckets = OrderedDict()
+        self.pending = {}
+        self.blocked = {}
+
+    def bucket(self, key, now):
+        """
+        Returns the bucket for `key`, evicting the least recently used ones
+        along with their pending hits and blocks
+        """
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, now)
+        self.buckets[key] = bucket
+        while len(self.buckets) > self.max_keys:
+            evicted, _ = self.buckets.popitem(last=False)
+            self.pending.pop(evicted, None)
+            self.blocked.pop(evicted, None)
+        return bucket
+
+    def sync(self, key, now):
+        """
+        Pushes pending hits of `key` to the shared store. Returns the seconds
+        left in the window when the shared total is over the limit
+        """
+        window_start = int(now // self.window * self.window)
+        amount = self.pending.pop(key, 0)
+        total = self.store.incr(key, window_start, self.window, amount)
+        if total <= self.window_limit:
+            return 0
+
+        retry_after = window_start + self.window - now
+        self.blocked[key] = now + retry_after
+        return retry_after
+
+    def hit(self, key):
+        """
+        Registers one request for `key`. Returns 0 when allowed, otherwise
+        the seconds the client should wait
+        """
+        now = self.clock()
+
+        blocked_until = self.blocked.get(key)
+        if blocked_until:
+            if blocked_until > now:
+                return blocked_until - now
+            del self.blocked[key]
+
+        retry_after = self.bucket(key, now).consume(now)
+        if retry_after or not self.store:
+            return retry_after
+
+        self.pending[key] = self.pending.get(key, 0) + 1
+        if self.pending[key] >= self.sync_every:
+            return self.sync(key, now)
+        return 0
+
+
+def retry_after_header(seconds):
+    """
+    Retry-After value in whole seconds, never less than one
+    """
+    return str(max(int(math.ceil(seconds)), 1))
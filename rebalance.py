@@ -0,0 +1,92 @@
+import argparse
+import os
+
+from db import DB
+
+"""
+Shard rebalance tool
+~~~~~~~~~~~~~~~~~~~~
+
+Moves every url whose owner changed between two shard layouts, with its
+click rollups, click events and archived copy. Run it after adding or
+removing a uri from MONGODB_SHARD_URIS, before pointing the api workers and
+aggregate.py at the new layout:
+
+    python rebalance.py --source a=URI1,b=URI2 --target a=URI1,b=URI2,c=URI3
+
+Shards are matched by name, as entries of MONGODB_SHARD_URIS. Changing the
+uri of a named shard moves nothing.
+"""
+
+# per shard collections partitioned by url code, with the fields identifying
+# a document and the stat counting the moved ones
+SHARDED = (
+    ('urls', ('code',), 'moved'),
+    ('urls_archive', ('_id',), 'archived_moved'),
+    ('url_rollups', ('code', 'dimension', 'key'), 'rollups_moved'),
+    ('url_clicks', ('_id',), 'clicks_moved'),
+)
+
+
+def rebalance(mongo_uri, source_uris, target_uris, dry_run=False):
+    """
+    Copies misplaced urls, archived urls, rollups and click events to their
+    new shard, then removes them from the old one. Returns a dict with the
+    number of scanned urls and moved documents
+    """
+    source = DB(mongo_uri, shard_uris=source_uris)
+    target = DB(mongo_uri, shard_uris=target_uris)
+    stats = {'scanned': 0, 'moved': 0, 'archived_moved': 0,
+             'rollups_moved': 0, 'clicks_moved': 0}
+
+    try:
+        for shard, (conn, database) in source.shards.items():
+            for name, fields, stat in SHARDED:
+                collection = conn[database][name]
+                for doc in collection.find():
+                    if name == 'urls':
+                        stats['scanned'] += 1
+                    owner = target.shard_for(doc['code'])
+                    if owner == shard:
+                        continue
+
+                    stats[stat] += 1
+                    if dry_run:
+                        continue
+
+                    # upsert keeps the copy idempotent if a previous run died
+                    # between the write and the delete
+                    target_conn, target_database = target.shards[owner]
+                    target_conn[target_database][name].replace_one(
+                        {field: doc[field] for field in fields}, doc,
+                        upsert=True
+                    )
+                    collection.delete_one({'_id': doc['_id']})
+    finally:
+        source.close()
+        target.close()
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shard rebalance tool')
+    parser.add_argument('--source', required=True,
+                        help='comma separated current name=uri shards')
+    parser.add_argument('--target', required=True,
+                        help='comma separated new name=uri shards')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only count the urls that would move')
+    args = parser.parse_args()
+
+    source_uris = DB.parse_shard_uris(args.source)
+    target_uris = DB.parse_shard_uris(args.target)
+    stats = rebalance(os.environ.get('MONGODB_URI'), source_uris, target_uris,
+                      dry_run=args.dry_run)
+    print('scanned={scanned} moved={moved} archived_moved={archived_moved} '
+          'rollups_moved={rollups_moved} '
+          'clicks_moved={clicks_moved}'.format(**stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,23 +2,46 @@ from collections import namedtuple
 import os
 # from unittest.mock import patch
 import datetime
+import io
+import json
 import random
+from urllib.parse import urlsplit
 
 import pytest
+import falcon
 import hug
 from bson.objectid import ObjectId
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+from pymongo.read_preferences import SecondaryPreferred
 from pymongo.uri_parser import parse_uri
 
-from helpers import clean_url, clean_email, hash_password
+from aggregate import aggregate, rollup_counts
+from archive import dead_urls_query
+from helpers import (api_key_fields, canonicalize_url, check_api_key,
+                     clean_url, clean_email, etag_matches, hash_password,
+                     parse_datetime, redirect_cache_control, serialize_url,
+                     short_url_code, split_api_key, url_etag, url_expired,
+                     url_hash)
+import formats
+from importer import chunks, run_import, validate_rows
+from ingest_clicks import ingest, parse_line
+from migrations import (INDEXES_V1, INDEXES_V4, INDEXES_V6, SCHEMA_VERSION,
+                        build_indexes, click_events, drop_short_url, migrate,
+                        rekey_api_keys, utc_dates)
 from db import DB
-from middlewares import HostEnvMiddleware, MongoMiddleware
+from hashring import HashRing
+from middlewares import HostEnvMiddleware, MongoMiddleware, RateLimitMiddleware
+from ratelimit import RateLimiter, TokenBucket
+from rebalance import rebalance
 
 """
 API endpoints test
 """
 
 TEST_MONGO_URL = os.environ.get('MONGODB_URI_TEST')
+# optional three member replica set, see `make replset`
+TEST_REPLSET_URL = os.environ.get('MONGODB_URI_REPLSET_TEST')
 
 USERS = (
     {'email': 'testuser1@email.com', 'api_key': 'apikey1'},
@@ -31,22 +54,34 @@ def create_fixtures():
     Creating user fixtures for tests
     """
     remove_fixtures()
+    migrate_test_db()
     with MongoClient(TEST_MONGO_URL) as conn:
         parsed = parse_uri(TEST_MONGO_URL)
         db = conn[parsed['database']]
         # adding user and one url for each user
         for i, user in enumerate(USERS):
-            user_id = db.users.insert(user)
+            doc = {'email': user['email']}
+            doc.update(api_key_fields(user['api_key']))
+            user_id = db.users.insert(doc)
             db.urls.insert({
                 'code': 'user{}'.format(i),
-                'short_url': 'http://ef.me/user{}'.format(i),
                 'long_url': 'http://user{}.com'.format(i),
+                'long_url_hash': url_hash('http://user{}.com'.format(i)),
                 'url_access': [],
-                'created_at': datetime.datetime.now(),
+                'created_at': datetime.datetime.utcnow(),
                 'created_by': user_id
             })
 
 
+def migrate_test_db():
+    """
+    Bringing the test database to the latest schema version
+    """
+    db = DB(TEST_MONGO_URL)
+    migrate(db, out=lambda line: None)
+    db.close()
+
+
 def remove_fixtures():
     """
     Removing fixtures
@@ -132,6 +167,11 @@ def test_short_url():
                             long_url='www.google.com', code='abcd')
     assert response.data['error'] == 'long_url already exists'
 
+    # same long url, written differently, is a duplicate too
+    response = hug.test.get(api, request_url, headers=headers,
+                            long_url='http://WWW.Google.com:80/')
+    assert response.data['error'] == 'long_url already exists'
+
     #  good request without generating short_url
     request_url = '/api/short'
     headers = {'X-Api-Key': 'apikey1'}
@@ -139,6 +179,19 @@ def test_short_url():
                             long_url='www.google.com/123')
     assert 'short_url' in response.data
 
+    # urls only differing by their query order are duplicates on demand
+    response = hug.test.get(api, request_url, headers=headers,
+                            long_url='g.com/search?q=a&lang=en',
+                            sort_query='1')
+    assert response.status == '201 Created'
+    response = hug.test.get(api, request_url, headers=headers,
+                            long_url='g.com/search?lang=en&q=a',
+                            sort_query='true')
+    assert response.data['error'] == 'long_url already exists'
+    response = hug.test.get(api, request_url, headers=headers,
+                            long_url='g.com/search?lang=en&q=a')
+    assert response.status == '201 Created'
+
     teardown()
 
 
@@ -169,6 +222,13 @@ def test_expand_url():
                             short_url='http://ef.me/noex')
     assert response.data['error'] == 'short_url does not exist'
 
+    # bad request with a code from another host
+    request_url = '/api/expand'
+    headers = {'X-Api-Key': 'apikey1'}
+    response = hug.test.get(api, request_url, headers=headers,
+                            short_url='http://other.me/user0')
+    assert response.data['error'] == 'short_url does not exist'
+
     # valid request
     request_url = '/api/expand'
     headers = {'X-Api-Key': 'apikey1'}
@@ -177,6 +237,11 @@ def test_expand_url():
     assert response.data['short_url'] == 'http://ef.me/user0'
     assert response.data['long_url'] == 'http://user0.com'
 
+    # other spellings of the same short url get the canonical one back
+    response = hug.test.get(api, request_url, headers=headers,
+                            short_url='http://EF.me/user0/')
+    assert response.data['short_url'] == 'http://ef.me/user0'
+
     teardown()
 
 
@@ -198,6 +263,168 @@ def test_go_to_url():
     teardown()
 
 
+def test_expiring_urls():
+    """
+    test expires_at and max_clicks on /api/short and /s/:code
+    """
+    setup()
+    import api
+    headers = {'X-Api-Key': 'apikey1'}
+
+    # bad requests
+    response = hug.test.get(api, '/api/short', headers=headers,
+                            long_url='http://expiring.com', expires_at='abc')
+    assert response.data['error'] == 'expires_at GET param is not valid'
+
+    response = hug.test.get(api, '/api/short', headers=headers,
+                            long_url='http://expiring.com',
+                            expires_at='2017-01-01')
+    assert response.data['error'] == 'expires_at must be in the future'
+
+    response = hug.test.get(api, '/api/short', headers=headers,
+                            long_url='http://expiring.com', max_clicks='0')
+    assert response.status == '400 Bad Request'
+
+    # click limited url
+    response = hug.test.get(api, '/api/short', headers=headers,
+                            long_url='http://expiring.com', code='once',
+                            max_clicks='1')
+    assert response.status == '201 Created'
+
+    response = hug.test.get(api, '/s/once')
+    assert response.status == '301 Moved Permanently'
+    response = hug.test.get(api, '/s/once')
+    assert response.status == '410 Gone'
+
+    # redirects that read the url before the last click was taken can't
+    # claim another one
+    db = DB(TEST_MONGO_URL)
+    click = {'date': datetime.datetime.utcnow()}
+    assert not db.log_access('once', click, max_clicks=1).matched_count
+    assert len(db.find_one_url({'code': 'once'})['url_access']) == 1
+
+    # click limits hold whatever the tracking mode, and are never cached
+    api.CLICK_TRACKING = 'beacon'
+    response = hug.test.get(api, '/api/short', headers=headers,
+                            long_url='http://expiring.com', code='twice',
+                            max_clicks='2')
+    assert response.status == '201 Created'
+    response = hug.test.get(api, '/s/twice')
+    assert response.headers_dict['cache-control'] == 'no-store'
+    hug.test.get(api, '/s/twice')
+    response = hug.test.get(api, '/s/twice')
+    assert response.status == '410 Gone'
+    api.CLICK_TRACKING = 'inline'
+
+    # date limited url
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    response = hug.test.get(api, '/api/short', headers=headers,
+                            long_url='http://expiring.com', code='hour',
+                            expires_at=expires_at.isoformat())
+    assert response.status == '201 Created'
+    response = hug.test.get(api, '/s/hour')
+    assert response.status == '301 Moved Permanently'
+
+    db.expire_url('hour', datetime.datetime.utcnow())
+    response = hug.test.get(api, '/s/hour')
+    assert response.status == '410 Gone'
+
+    # archiving moves dead urls with their access log, dropping their stats
+    urls = db.url_collection('once')
+    db.inc_rollups(urls, {('once', 'referrer', 'direct'): 1})
+    later = datetime.datetime.utcnow() + datetime.timedelta(days=2)
+    assert db.archive_urls(dead_urls_query(later)) == 3
+    assert db.find_one_url({'code': 'hour'}) is None
+    assert db.find_one_url({'code': 'user0'})
+    archive = db.conn[db.database].urls_archive
+    archived = archive.find_one({'code': 'once'})
+    assert len(archived['url_access']) == 1
+    assert 'archived_at' in archived
+    assert not list(db.find_rollups('once', 'referrer', 10))
+
+    # idle urls are only archived on demand
+    assert '$or' not in dead_urls_query(later)
+    assert '$or' in dead_urls_query(later, idle_days=365)
+
+    # archived codes are never issued again
+    assert db.code_exists('once')
+    response = hug.test.get(api, '/api/short', headers=headers,
+                            long_url='http://reused.com', code='once')
+    assert response.data['error'] == 'code is not available'
+    duplicates = []
+    assert db.insert_urls([{'code': 'once', 'long_url': 'http://reused.com',
+                            'url_access': [], 'created_at': later}],
+                          duplicates) == 0
+    assert len(duplicates) == 1
+
+    # codes removed by the former TTL index start with empty stats
+    db.inc_rollups(urls, {('once', 'referrer', 'direct'): 1})
+    db.insert_url({'code': 'once', 'long_url': 'http://reused.com',
+                   'url_access': [], 'created_at': later})
+    assert not list(db.find_rollups('once', 'referrer', 10))
+
+    urls.remove({'code': 'once'})
+    archive.remove({'code': {'$in': ['once', 'hour', 'twice']}})
+    db.close()
+    teardown()
+
+
+def test_url_stats():
+    """
+    test /api/urls/{code}/stats endpoint
+    """
+    setup()
+    import api
+    db = DB(TEST_MONGO_URL)
+    db.set_checkpoint('click_rollups', None)
+
+    # bad requests
+    response = hug.test.get(api, '/api/urls/user0/stats')
+    assert response.status == '401 Unauthorized'
+
+    headers = {'X-Api-Key': 'apikey1'}
+    response = hug.test.get(api, '/api/urls/user0/stats', headers=headers,
+                            granularity='week')
+    assert response.status == '400 Bad Request'
+
+    response = hug.test.get(api, '/api/urls/user1/stats', headers=headers)
+    assert response.data['error'] == 'URL does not exist'
+
+    # clicks only show up once aggregated
+    hug.test.get(api, '/s/user0', headers={'Referer': 'http://t.co/abc'})
+    hug.test.get(api, '/s/user0')
+    response = hug.test.get(api, '/api/urls/user0/stats', headers=headers)
+    assert response.data['clicks'] == []
+
+    until = datetime.datetime.utcnow()
+    assert aggregate(db, until=until) == 2
+    response = hug.test.get(api, '/api/urls/user0/stats', headers=headers,
+                            granularity='day').data
+    assert [i['clicks'] for i in response['clicks']] == [2]
+    referrers = {i['referrer']: i['clicks'] for i in response['referrers']}
+    assert referrers == {'t.co': 1, 'direct': 1}
+
+    # next run only folds new clicks in
+    assert aggregate(db, until=until) == 0
+    hug.test.get(api, '/s/user0')
+    assert aggregate(db, until=datetime.datetime.utcnow()) == 1
+    response = hug.test.get(api, '/api/urls/user0/stats', headers=headers,
+                            granularity='day').data
+    assert [i['clicks'] for i in response['clicks']] == [3]
+
+    # clicks ingested late from CDN logs are counted in their own bucket
+    ingest(db, ['1.2.3.4 - - [21/Mar/2017:20:37:57 +0000] '
+                '"GET /s/user0 HTTP/1.1" 301 0'])
+    assert aggregate(db, until=datetime.datetime.utcnow()) == 1
+    response = hug.test.get(api, '/api/urls/user0/stats', headers=headers,
+                            granularity='day', limit='2').data
+    assert [i['clicks'] for i in response['clicks']] == [1, 3]
+
+    db.conn[db.database].url_rollups.remove({'code': 'user0'})
+    db.close()
+    teardown()
+
+
 def test_create_user():
     """
     testing /api/user endpoint
@@ -225,6 +452,24 @@ def test_create_user():
     assert response.status == '200 OK'
     assert 'api_key' in response.data
 
+    # the new key is usable, but never stored in plain text
+    api_key = response.data['api_key']
+    headers = {'X-Api-Key': api_key}
+    response = hug.test.get(api, '/api/urls', headers=headers)
+    assert response.status == '200 OK'
+
+    db = DB(TEST_MONGO_URL)
+    user = db.find_one_user({'email': 'testuser3@email.com'})
+    assert 'api_key' not in user
+    assert api_key not in str(user)
+    db.close()
+
+    # same prefix, wrong secret
+    prefix, _ = split_api_key(api_key)
+    headers = {'X-Api-Key': '{}.wrong'.format(prefix)}
+    response = hug.test.get(api, '/api/urls', headers=headers)
+    assert response.status == '401 Unauthorized'
+
     teardown()
 
 
@@ -304,6 +549,89 @@ def test_get_user_url():
     teardown()
 
 
+def test_conditional_get():
+    """
+    test ETag and If-None-Match handling on read endpoints
+    """
+    setup()
+    import api
+
+    headers = {'X-Api-Key': 'apikey1'}
+    response = hug.test.get(api, '/api/urls/user0', headers=headers)
+    etag = response.headers_dict['etag']
+    assert 'last-modified' in response.headers_dict
+
+    # same etag returns a 304 without body
+    headers['If-None-Match'] = etag
+    response = hug.test.get(api, '/api/urls/user0', headers=headers)
+    assert response.status == '304 Not Modified'
+
+    # expand has its own representation, so its own etag
+    response = hug.test.get(api, '/api/expand', headers=headers,
+                            short_url='http://ef.me/user0')
+    assert response.status == '200 OK'
+    expand_etag = response.headers_dict['etag']
+    assert expand_etag != etag
+
+    headers['If-None-Match'] = expand_etag
+    response = hug.test.get(api, '/api/expand', headers=headers,
+                            short_url='http://ef.me/user0')
+    assert response.status == '304 Not Modified'
+
+    # a click updates the url, invalidating the old etag
+    hug.test.get(api, '/s/user0')
+    headers['If-None-Match'] = etag
+    response = hug.test.get(api, '/api/urls/user0', headers=headers)
+    assert response.status == '200 OK'
+    assert response.headers_dict['etag'] != etag
+    assert response.data['total_accesses'] == 1
+
+    teardown()
+
+
+def test_click_beacon():
+    """
+    test /s/:code/beacon endpoint
+    """
+    setup()
+    import api
+
+    # only served with beacon tracking
+    beacon = {'X-Beacon-Secret': 'secret'}
+    response = hug.test.post(api, '/s/user0/beacon', headers=beacon)
+    assert response.status == '404 Not Found'
+
+    api.CLICK_TRACKING = 'beacon'
+    api.BEACON_SECRET = 'secret'
+
+    response = hug.test.post(api, '/s/user0/beacon')
+    assert response.status == '403 Forbidden'
+    response = hug.test.post(api, '/s/user0/beacon',
+                             headers={'X-Beacon-Secret': 'wrong'})
+    assert response.status == '403 Forbidden'
+
+    response = hug.test.post(api, '/s/123/beacon', headers=beacon)
+    assert response.status == '404 Not Found'
+
+    response = hug.test.post(api, '/s/user0/beacon', headers=beacon)
+    assert response.status == '204 No Content'
+
+    headers = {'X-Api-Key': 'apikey1'}
+    response = hug.test.get(api, '/api/urls/user0', headers=headers)
+    assert response.data['total_accesses'] == 1
+
+    # click limited urls are only counted on redirect
+    response = hug.test.get(api, '/api/short', headers=headers,
+                            long_url='http://limited.com', code='limited',
+                            max_clicks='5')
+    response = hug.test.post(api, '/s/limited/beacon', headers=beacon)
+    assert response.status == '404 Not Found'
+
+    api.CLICK_TRACKING = 'inline'
+    api.BEACON_SECRET = ''
+    teardown()
+
+
 """
 Helpers test
 """
@@ -330,6 +658,264 @@ def test_clean_url():
     assert clean_url(with_trailing_slash) == good
 
 
+def test_url_etag():
+    """
+    testing url_etag and etag_matches helpers
+    """
+    url = {'_id': ObjectId('58d0211ea1711d51401aee4c'),
+           'created_at': datetime.datetime(2017, 1, 1)}
+    etag = url_etag(url)
+    assert etag.startswith('"') and etag.endswith('"')
+    assert url_etag(url, 'expand') != etag
+
+    url['updated_at'] = datetime.datetime(2017, 1, 2)
+    assert url_etag(url) != etag
+
+    etag = url_etag(url)
+    assert etag_matches(etag, etag)
+    assert etag_matches('"abc", {}'.format(etag), etag)
+    assert etag_matches('W/{}'.format(etag), etag)
+    assert etag_matches('*', etag)
+    assert not etag_matches('"abc"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_parse_log_line():
+    """
+    testing CDN access log parsing
+    """
+    line = ('1.2.3.4 - - [21/Mar/2017:20:37:57 +0100] "GET /s/user0 HTTP/1.1"'
+            ' 301 0 "-" "curl/7.0"')
+    assert parse_line(line) == ('user0', {
+        'date': datetime.datetime(2017, 3, 21, 19, 37, 57),
+        'referrer': None,
+        'user_agent': 'curl/7.0',
+    })
+
+    # common log format has no headers
+    line = '1.2.3.4 - - [21/Mar/2017:20:37:57 +0000] "GET /s/user0 HTTP/1.1" 301 0'
+    assert parse_line(line)[1]['referrer'] is None
+
+    # only redirects count as clicks
+    assert parse_line(line.replace(' 301 ', ' 404 ')) is None
+    assert parse_line(line.replace('/s/user0', '/api/urls')) is None
+    assert parse_line('garbage') is None
+
+
+def test_ingest_clicks():
+    """
+    testing CDN access log ingestion
+    """
+    setup()
+    lines = [
+        '1.2.3.4 - - [21/Mar/2017:20:37:57 +0000] "GET /s/user0 HTTP/1.1" 301 0',
+        '1.2.3.4 - - [21/Mar/2017:20:37:58 +0000] "GET /s/user0 HTTP/1.1" 301 0',
+        '1.2.3.4 - - [21/Mar/2017:20:37:59 +0000] "GET /api/urls HTTP/1.1" 200 0',
+    ]
+    db = DB(TEST_MONGO_URL)
+    assert ingest(db, lines) == 2
+    assert len(db.find_one_url({'code': 'user0'})['url_access']) == 2
+    db.close()
+    teardown()
+
+
+def test_rollup_counts():
+    """
+    testing click rollup bucketing
+    """
+    date = datetime.datetime(2017, 3, 21, 20, 37, 57, 123)
+    events = [
+        {'code': 'a', 'date': date, 'referrer': 'http://T.co/x',
+         'user_agent': 'curl'},
+        {'code': 'a', 'date': date + datetime.timedelta(minutes=1)},
+    ]
+    counts = rollup_counts(events)
+    assert counts[('a', 'minute', datetime.datetime(2017, 3, 21, 20, 37))] == 1
+    assert counts[('a', 'minute', datetime.datetime(2017, 3, 21, 20, 38))] == 1
+    assert counts[('a', 'hour', datetime.datetime(2017, 3, 21, 20))] == 2
+    assert counts[('a', 'day', datetime.datetime(2017, 3, 21))] == 2
+    assert counts[('a', 'referrer', 't.co')] == 1
+    assert counts[('a', 'referrer', 'direct')] == 1
+    assert counts[('a', 'user_agent', 'curl')] == 1
+    assert counts[('a', 'user_agent', 'unknown')] == 1
+
+
+def test_serialize_url():
+    """
+    testing serialize_url helper
+    """
+    now = datetime.datetime.utcnow()
+    url = {
+        '_id': ObjectId(),
+        'long_url': 'http://user0.com',
+        'code': 'user0',
+        'url_access': [{'date': now}],
+        'created_at': now,
+        'created_by': ObjectId(),
+    }
+    assert serialize_url(url, 'http://ef.me') == {
+        'long_url': 'http://user0.com',
+        'short_url': 'http://ef.me/user0',
+        'code': 'user0',
+        'url_access': [{'date': now}],
+        'total_accesses': 1,
+        'created_at': now,
+    }
+
+
+def test_short_url_code():
+    """
+    testing short_url_code helper
+    """
+    assert short_url_code('http://ef.me/abc', 'http://ef.me') == 'abc'
+    assert short_url_code('https://EF.me/abc', 'http://ef.me') == 'abc'
+    assert short_url_code('http://ef.me/s/abc', 'http://ef.me/s') == 'abc'
+    assert short_url_code('http://other.me/abc', 'http://ef.me') is None
+    assert short_url_code('http://ef.me', 'http://ef.me') is None
+    assert short_url_code('http://ef.me/a/b', 'http://ef.me') is None
+
+
+def test_json_output():
+    """
+    testing the json output format matches hug default one
+    """
+    now = datetime.datetime(2017, 3, 21, 20, 37, 57, 190000)
+    oid = ObjectId('58d0211ea1711d51401aee4c')
+    content = {'created_at': now, 'list': [1, 'a'], 'id': oid,
+               'cursor': (i for i in range(2))}
+
+    assert json.loads(formats.json(content).decode('utf-8')) == {
+        'created_at': '2017-03-21T20:37:57.190000',
+        'list': [1, 'a'],
+        'id': '58d0211ea1711d51401aee4c',
+        'cursor': [0, 1],
+    }
+    assert formats.json.content_type.startswith('application/json')
+
+    with pytest.raises(TypeError):
+        formats.json({'bad': object()})
+
+
+def test_parse_datetime():
+    """
+    testing parse_datetime helper
+    """
+    assert parse_datetime('2017-03-21') == datetime.datetime(2017, 3, 21)
+    assert parse_datetime('2017-03-21T20:37:57') == \
+        datetime.datetime(2017, 3, 21, 20, 37, 57)
+    assert parse_datetime('2017-03-21T20:37:57.190000') == \
+        datetime.datetime(2017, 3, 21, 20, 37, 57, 190000)
+
+    with pytest.raises(ValueError):
+        parse_datetime('21/03/2017')
+
+    with pytest.raises(ValueError):
+        parse_datetime(123)
+
+
+def test_url_expiry():
+    """
+    testing url_expired and redirect_cache_control helpers
+    """
+    now = datetime.datetime(2017, 3, 21)
+    url = {'url_access': []}
+    assert not url_expired(url, now)
+    assert redirect_cache_control(url, None, now) is None
+    assert redirect_cache_control(url, 'public, max-age=300', now) == \
+        'public, max-age=300'
+
+    url['expires_at'] = now + datetime.timedelta(seconds=60)
+    assert not url_expired(url, now)
+    assert url_expired(url, url['expires_at'])
+    assert redirect_cache_control(url, 'public, max-age=300, s-maxage=30',
+                                  now) == 'public, max-age=60, s-maxage=30'
+    # dated urls are never cached past their expiry, policy or not
+    assert redirect_cache_control(url, None, now) == 'max-age=60'
+    assert redirect_cache_control(url, 'public', now) == 'public, max-age=60'
+
+    url = {'url_access': [{'date': now}], 'max_clicks': 2}
+    assert not url_expired(url, now)
+    assert redirect_cache_control(url, 'public, max-age=300', now) == \
+        'no-store'
+    assert redirect_cache_control(url, None, now) == 'no-store'
+    url['url_access'].append({'date': now})
+    assert url_expired(url, now)
+
+
+def test_canonicalize_url():
+    """
+    testing canonicalize_url and url_hash helpers
+    """
+    assert canonicalize_url('google.com') == 'http://google.com'
+    assert canonicalize_url('http://User@WWW.Google.COM:80/A/') == \
+        'http://User@www.google.com/A'
+    assert canonicalize_url('https://g.com:443/?b=2&a=1') == \
+        'https://g.com/?b=2&a=1'
+    assert canonicalize_url('HTTPS://example.org:443/a?b=2&a=1') == \
+        'https://example.org/a?b=2&a=1'
+    assert canonicalize_url('Http://G.com:80/') == 'http://g.com'
+
+    # query params are only sorted on demand, blank ones kept
+    assert canonicalize_url('https://g.com:443/?b=2&a=1',
+                            sort_query=True) == 'https://g.com/?a=1&b=2'
+    assert canonicalize_url('http://g.com/?c=&b=%2F&a=1#x',
+                            sort_query=True) == 'http://g.com/?a=1&b=%2F&c=#x'
+    assert canonicalize_url('http://g.com/a?b=%2F#x') == \
+        'http://g.com/a?b=%2F#x'
+    assert canonicalize_url('http://g.com/a?#') == 'http://g.com/a'
+    assert canonicalize_url('http://g.com/a?b=/#//') == 'http://g.com/a?b='
+    assert canonicalize_url('http://[::1]:80/x') == 'http://[::1]/x'
+
+    for bad in (123, '', 'http://g.com:abc', 'http://g.com:99999'):
+        with pytest.raises(ValueError):
+            canonicalize_url(bad)
+
+    assert url_hash('http://g.com') == url_hash('http://g.com')
+    assert url_hash('http://g.com') != url_hash('http://g.com/a')
+    assert len(url_hash('http://g.com/' + 'a' * 5000)) == 16
+
+
+def test_canonicalize_url_properties():
+    """
+    canonicalize_url is equivalent to or stricter than clean_url, on
+    random combinations of url parts
+    """
+    parts = (
+        ('', 'http://', 'https://', 'HTTP://', 'Https://', 'ftp://'),
+        ('', 'u:p@', 'U@'),
+        ('ef.me', 'EF.me', 'a-b.COM', '127.0.0.1', '[::1]', '', 'x y.com'),
+        ('', ':80', ':443', ':8080', ':abc', ':', ':99999'),
+        ('', '/', '/a', '/A/b/', '//', '/a b', '/%20', '/;p'),
+        ('', '?', '?b=2&a=1', '?a=/', '?a=1&a=1', '?a=%2F'),
+        ('', '#', '#x', '#/', '#//'),
+    )
+    rand = random.Random(0)
+    for _ in range(5000):
+        url = ''.join(rand.choice(part) for part in parts)
+        try:
+            cleaned = clean_url(url)
+        except ValueError:
+            # anything clean_url rejects is rejected too
+            with pytest.raises(ValueError):
+                canonicalize_url(url)
+            continue
+
+        try:
+            canonical = canonicalize_url(url)
+        except ValueError:
+            continue
+        # same result as canonicalizing clean_url output, and stable
+        assert canonicalize_url(cleaned) == canonical
+        assert canonicalize_url(canonical) == canonical
+        # always a lowercase http url with a host
+        parsed = urlsplit(canonical)
+        assert parsed.scheme in ('http', 'https') and parsed.hostname
+
+        # sorting the query is stable too
+        canonical = canonicalize_url(url, sort_query=True)
+        assert canonicalize_url(canonical, sort_query=True) == canonical
+
+
 def test_clean_email():
     """
     testing clean_email helper
@@ -351,12 +937,233 @@ def test_clean_email():
     assert clean_email(good) == good
 
 
+def test_api_key_helpers():
+    """
+    testing api key split, storage and check helpers
+    """
+    assert split_api_key('0123456789ab.secret') == ('0123456789ab', 'secret')
+    # legacy keys are their own secret
+    legacy = 'd0088c5e26b377da76477cda8d7d2f2e'
+    assert split_api_key(legacy) == ('d0088c5e26b3', legacy)
+
+    for bad in ('', None, '.secret', 'prefix.'):
+        with pytest.raises(ValueError):
+            split_api_key(bad)
+
+    user = api_key_fields('0123456789ab.secret')
+    assert user['api_key_prefix'] == '0123456789ab'
+    assert len(user['api_key_hash']) == 32
+    assert check_api_key(user, 'secret')
+    assert not check_api_key(user, 'other')
+
+
 def test_hash_password():
     expected = 'd0088c5e26b377da76477cda8d7d2f2e5a3723176eb2a1ddf6c4719d567c3bfe7141f1998a1e3a3cbec86c96740d7d25bc954e2970d4974b66193a9ea210a8af'
 
     assert hash_password('test@email.com', 'salt123') == expected
 
 
+"""
+Importer test
+"""
+
+
+def test_validate_rows():
+    rows = [
+        (1, {'long_url': 'Google.com:80/', 'code': 'abc'}),
+        (2, {'long_url': 'http://g.com', 'code': 'abc',
+             'created_at': '2017-03-21'}),
+        (3, {'long_url': '', 'code': 'abc'}),
+        (4, {'long_url': 'http://g.com', 'code': 'waytoolongcode'}),
+        (5, {'long_url': 'http://g.com'}),
+        (6, {'long_url': 'http://g.com', 'code': 'a', 'created_at': 'x'}),
+        (7, None),
+        (8, {'long_url': 'http://g.com', 'code': 'a/b'}),
+        (9, {'long_url': 'http://g.com', 'code': 'a b'}),
+        (10, {'long_url': 'http://g.com', 'code': 'ab\n'}),
+        (11, {'long_url': 'http://g.com', 'code': 'ab?c'}),
+        (12, {'long_url': 'http://g.com', 'code': 'A_b-9'}),
+    ]
+    urls, rejects = validate_rows(rows)
+
+    assert [number for number, _ in urls] == [1, 2, 12]
+    assert urls[0][1]['long_url'] == 'http://google.com'
+    assert urls[0][1]['long_url_hash'] == url_hash('http://google.com')
+    assert urls[1][1]['created_at'] == datetime.datetime(2017, 3, 21)
+    assert [reject['row'] for reject in rejects] == [3, 4, 5, 6, 7, 8, 9,
+                                                     10, 11]
+
+
+def test_import_chunks():
+    assert list(chunks('abcde', 0, 2)) == [
+        [(1, 'a'), (2, 'b')], [(3, 'c'), (4, 'd')], [(5, 'e')]
+    ]
+    # resuming skips the rows already imported
+    assert list(chunks('abcde', 3, 2)) == [[(4, 'd'), (5, 'e')]]
+
+
+def test_run_import(tmpdir):
+    setup()
+    db = DB(TEST_MONGO_URL)
+    owner = db.find_one_user({'email': 'testuser1@email.com'})
+
+    path = tmpdir.join('links.csv')
+    path.write('long_url,code\n'
+               'http://a.com,imp1\n'
+               ',imp2\n'
+               'http://b.com,imp1\n'
+               'http://c.com,user1\n'
+               'http://d.com,imp3\n')
+
+    rejects = io.StringIO()
+    checkpoint = run_import(db, str(path), owner['_id'], batch_size=2,
+                            workers=2, rejects_file=rejects,
+                            out=io.StringIO())
+    assert checkpoint == {'row': 5, 'inserted': 2, 'collisions': 2,
+                          'invalid': 1}
+    assert db.find_one_url({'code': 'imp1'})['long_url'] == 'http://a.com'
+    assert db.find_one_url({'code': 'imp3'})['created_by'] == owner['_id']
+
+    errors = [json.loads(line) for line in rejects.getvalue().splitlines()]
+    assert {error['row'] for error in errors} == {2, 3, 4}
+
+    # a finished import has nothing left to resume
+    path.write('http://e.com,imp4\n', mode='a')
+    checkpoint = run_import(db, str(path), owner['_id'], batch_size=2,
+                            workers=2, out=io.StringIO())
+    assert checkpoint['row'] == 6
+    assert checkpoint['inserted'] == 3
+
+    db.close()
+    teardown()
+
+
+"""
+Migrations test
+"""
+
+
+def test_migrate():
+    db = DB(TEST_MONGO_URL)
+    db.set_schema_version(0)
+
+    lines = []
+    assert migrate(db, target=1, out=lines.append) == [1]
+    assert db.get_schema_version() == 1
+    assert lines == ['applying 1 create_indexes']
+
+    # resumes from the saved version, then has nothing left to do
+    assert migrate(db, out=lines.append) == list(range(2, SCHEMA_VERSION + 1))
+    assert db.get_schema_version() == SCHEMA_VERSION
+    assert migrate(db, out=lines.append) == []
+    db.close()
+
+
+def test_build_indexes():
+    uris = shard_uris(1)
+    drop_shards(uris)
+    db = DB(TEST_MONGO_URL, shard_uris=uris)
+    for _ in range(2):
+        db.url_collection('dup').insert({'code': 'dup'})
+
+    # failed builds are raised, so the migration is not recorded
+    with pytest.raises(OperationFailure):
+        build_indexes(db, INDEXES_V1)
+
+    db.url_collection('dup').remove({'code': 'dup'})
+    build_indexes(db, INDEXES_V1 + INDEXES_V4)
+    assert 'code_1' in db.url_collection('dup').index_information()
+    db.close()
+    drop_shards(uris)
+
+
+def test_drop_short_url():
+    setup()
+    db = DB(TEST_MONGO_URL)
+    urls = db.conn[db.database].urls
+    urls.update({'code': 'user0'},
+                {'$set': {'short_url': 'http://ef.me/user0'}})
+
+    report = drop_short_url(db)
+    assert report[0]['collection'] == urls.full_name
+    assert 'size_saved' in report[0] and 'index_size_saved' in report[0]
+    assert 'short_url' not in urls.find_one({'code': 'user0'})
+
+    db.close()
+    teardown()
+
+
+def test_rekey_api_keys():
+    setup()
+    db = DB(TEST_MONGO_URL)
+    users = db.conn[db.database].users
+    legacy = 'd0088c5e26b377da76477cda8d7d2f2e'
+    users.insert({'email': 'testuser3@email.com', 'api_key': legacy})
+
+    report = rekey_api_keys(db)
+    assert report[0]['collection'] == users.full_name
+
+    user = db.find_one_user({'email': 'testuser3@email.com'})
+    assert 'api_key' not in user
+    assert user['api_key_prefix'] == legacy[:12]
+    assert check_api_key(user, legacy)
+
+    db.close()
+    teardown()
+
+
+def test_click_events():
+    setup()
+    db = DB(TEST_MONGO_URL)
+    urls = db.conn[db.database].urls
+    clicks = db.conn[db.database].url_clicks
+    clicks.remove({})
+    checkpoint = datetime.datetime(2017, 3, 20, 12, 0)
+    db.set_checkpoint('click_rollups', checkpoint, urls)
+    urls.update({'code': 'user0'}, {'$set': {
+        'updated_at': checkpoint + datetime.timedelta(minutes=1),
+        'url_access': [{'date': checkpoint},
+                       {'date': checkpoint,
+                        'logged_at': checkpoint + datetime.timedelta(1)}],
+    }})
+
+    # only accesses the job did not fold yet are copied, logged from now
+    click_events(db)
+    events = list(clicks.find({'code': 'user0'}))
+    assert [event['date'] for event in events] == [checkpoint]
+    assert events[0]['logged_at'] > checkpoint
+    assert 'logged_at_1' in clicks.index_information()
+
+    clicks.remove({})
+    db.set_checkpoint('click_rollups', None, urls)
+    db.close()
+    teardown()
+
+
+def test_utc_dates():
+    setup()
+    db = DB(TEST_MONGO_URL)
+    urls = db.conn[db.database].urls
+    local = datetime.datetime(2017, 3, 20, 12, 0)
+    logged_at = datetime.datetime.utcnow()
+    urls.update({'code': 'user0'}, {'$set': {
+        'created_at': local,
+        'url_access': [{'date': local},
+                       {'date': logged_at, 'logged_at': logged_at}],
+    }})
+
+    # servers ran at UTC-3
+    utc_dates(db, offset=-180)
+    url = urls.find_one({'code': 'user0'})
+    assert url['created_at'] == datetime.datetime(2017, 3, 20, 15, 0)
+    assert url['url_access'][0]['date'] == url['created_at']
+    assert url['url_access'][1]['date'] == logged_at.replace(
+        microsecond=logged_at.microsecond // 1000 * 1000)
+
+    db.close()
+    teardown()
+
+
 """
 Middleware test
 """
@@ -385,6 +1192,7 @@ def test_env_middleware():
 def test_mongo_middleware():
     os.environ['MONGODB_URI'] = TEST_MONGO_URL
     parsed = parse_uri(TEST_MONGO_URL)
+    migrate_test_db()
 
     fake_request = namedtuple('Request', 'context')
     fake_response = {}
@@ -398,9 +1206,74 @@ def test_mongo_middleware():
     m.process_response(req, {}, {})
     assert req.context['db'] is None
 
+    # workers refuse to boot on a database not migrated
+    db = DB(TEST_MONGO_URL)
+    db.set_schema_version(SCHEMA_VERSION - 1)
+    with pytest.raises(Exception):
+        MongoMiddleware()
+    db.set_schema_version(SCHEMA_VERSION)
+    db.close()
+
     os.environ['MONGODB_URI'] = ''
 
 
+class FakeRequest:
+    """
+    Minimal falcon request stand-in for middleware tests
+    """
+    def __init__(self, path, remote_addr='127.0.0.1', headers=None):
+        self.path = path
+        self.remote_addr = remote_addr
+        self.headers = headers or {}
+        self.context = {}
+
+    def get_header(self, name):
+        return self.headers.get(name)
+
+
+def test_rate_limit_middleware():
+    m = RateLimitMiddleware(key_rate=1, key_burst=2, ip_rate=1, ip_burst=3)
+    headers = {'X-Api-Key': 'apikey1'}
+
+    # per key limit
+    m.process_request(FakeRequest('/api/short', headers=headers), {})
+    m.process_request(FakeRequest('/api/short', headers=headers), {})
+    with pytest.raises(falcon.HTTPError) as exc:
+        m.process_request(FakeRequest('/api/short', headers=headers), {})
+    assert exc.value.status == falcon.HTTP_429
+    assert exc.value.headers['Retry-After'] == '1'
+
+    # per ip limit, even with other keys
+    headers = {'X-Api-Key': 'apikey2'}
+    with pytest.raises(falcon.HTTPError):
+        m.process_request(FakeRequest('/api/short', headers=headers), {})
+
+    # other clients and the redirect route are not limited
+    m.process_request(FakeRequest('/api/short', remote_addr='10.0.0.1'), {})
+    for _ in range(5):
+        m.process_request(FakeRequest('/s/user0'), {})
+
+    # forged keys sharing a user key prefix never drain its bucket
+    m = RateLimitMiddleware(key_rate=1, key_burst=2, ip_rate=10, ip_burst=10)
+    owner = {'X-Api-Key': 'abcdef123456.secret'}
+    for i in range(3):
+        forged = {'X-Api-Key': 'abcdef123456.forged{}'.format(i)}
+        m.process_request(FakeRequest('/api/short', '10.0.0.2', forged), {})
+        m.process_request(FakeRequest('/api/short', '10.0.0.2', forged), {})
+    m.process_request(FakeRequest('/api/short', headers=owner), {})
+
+    # behind a trusted proxy, clients are told apart by the address it
+    # appended, and forged X-Forwarded-For entries are ignored
+    m = RateLimitMiddleware(ip_rate=1, ip_burst=1, trusted_proxies=1)
+    assert m.client_ip(FakeRequest('/api/short', '10.0.0.9')) == '10.0.0.9'
+    for client in ('1.1.1.1', '2.2.2.2'):
+        headers = {'X-Forwarded-For': 'spoofed, {}'.format(client)}
+        m.process_request(FakeRequest('/api/short', '10.0.0.9', headers), {})
+    headers = {'X-Forwarded-For': 'other, 1.1.1.1'}
+    with pytest.raises(falcon.HTTPError):
+        m.process_request(FakeRequest('/api/short', '10.0.0.9', headers), {})
+
+
 """
 DB test
 """
@@ -413,3 +1286,269 @@ def test_sanitize_query():
     assert DB.sanitize_query(bad) is False
     assert DB.sanitize_query(good) == {}
     assert DB.sanitize_query(good2) == {'_id': ObjectId('58d0211ea1711d51401aee4c')}
+
+
+def test_read_routing():
+    db = DB('mongodb://localhost:27017/ef_test', write_concern='majority',
+            max_staleness=120)
+    assert db.conn.write_concern.document == {'w': 'majority'}
+
+    urls = db.url_collection('abc')
+
+    # writes and untagged reads stay on the primary
+    assert db.for_read(urls, None).read_preference.mode == 0
+    assert db.for_read(urls, 'write').read_preference.mode == 0
+
+    read = db.for_read(urls, 'redirect')
+    assert read.read_preference == SecondaryPreferred(max_staleness=120)
+
+    # read your writes, for as long as secondaries may lag
+    written_at = datetime.datetime.utcnow()
+    assert db.for_read(urls, 'list', written_at).read_preference.mode == 0
+    written_at -= datetime.timedelta(seconds=120)
+    assert db.for_read(urls, 'list', written_at).read_preference.mode != 0
+    db.close()
+
+
+@pytest.mark.skipif(not TEST_REPLSET_URL,
+                    reason='MONGODB_URI_REPLSET_TEST is not set')
+def test_replica_set_reads():
+    db = DB(TEST_REPLSET_URL, write_concern=1)
+    build_indexes(db, INDEXES_V1 + INDEXES_V4)
+    user_id = db.insert_user({'email': 'replset@email.com'}).inserted_id
+    code = db.generate_url_code('http://ef.me')
+    db.insert_url({
+        'code': code,
+        'long_url': 'http://replset.com',
+        'url_access': [],
+        'created_at': datetime.datetime.utcnow(),
+        'created_by': user_id,
+    })
+
+    # readable right away, by this process and by any other one
+    assert db.find_one_url({'code': code}, read='redirect')
+    assert len(list(db.find_urls(user_id, read='list'))) == 1
+
+    # other workers see the write through the user document, read from the
+    # primary on every authenticated request
+    other = DB(TEST_REPLSET_URL)
+    assert other.find_one_url({'code': code}, read='redirect')
+    written_at = other.find_one_user({'_id': user_id})['last_write_at']
+    assert len(list(other.find_urls(user_id, read='list',
+                                    written_at=written_at))) == 1
+    other.close()
+
+    db.url_collection(code).delete_one({'code': code})
+    db.conn[db.database].users.delete_one({'_id': user_id})
+    db.close()
+
+
+"""
+Sharding test
+"""
+
+
+def shard_uris(count):
+    """
+    Local mongo stand-ins for shards: one database per shard on the test
+    server
+    """
+    return ['{}_shard{}'.format(TEST_MONGO_URL, i) for i in range(count)]
+
+
+def drop_shards(uris):
+    for uri in uris:
+        with MongoClient(uri) as conn:
+            conn.drop_database(parse_uri(uri)['database'])
+
+
+def test_hash_ring():
+    ring = HashRing(['a', 'b', 'c'])
+    codes = ['code{}'.format(i) for i in range(3000)]
+    owners = {code: ring.get_node(code) for code in codes}
+
+    # stable and reasonably balanced
+    assert owners == {code: ring.get_node(code) for code in codes}
+    for node in ('a', 'b', 'c'):
+        assert 700 < list(owners.values()).count(node) < 1300
+
+    # adding a node only moves keys to the new node
+    ring.add_node('d')
+    for code in codes:
+        node = ring.get_node(code)
+        assert node == owners[code] or node == 'd'
+
+    # removing it brings the original layout back
+    ring.remove_node('d')
+    assert owners == {code: ring.get_node(code) for code in codes}
+
+    with pytest.raises(ValueError):
+        HashRing().get_node('abc')
+
+
+def test_shard_entries():
+    entries = DB.parse_shard_uris(
+        'a=mongodb://h1,h2/ef?replicaSet=rs, b=mongodb://h3/ef')
+    assert entries == ['a=mongodb://h1,h2/ef?replicaSet=rs',
+                       'b=mongodb://h3/ef']
+    assert DB.parse_shard_uris('mongodb://h1/ef,mongodb://h2/ef') == \
+        ['mongodb://h1/ef', 'mongodb://h2/ef']
+    assert DB.parse_shard_uris(None) == []
+    assert DB.shard_entry('mongodb://h1/ef') == \
+        ('mongodb://h1/ef', 'mongodb://h1/ef')
+
+    # moving a host or rotating a password keeps every code in place
+    before = DB('mongodb://localhost:27017/ef_test',
+                shard_uris=['a=mongodb://u:p@h1/ef', 'b=mongodb://h2/ef'])
+    after = DB('mongodb://localhost:27017/ef_test',
+               shard_uris=['a=mongodb://u:q@h4/ef', 'b=mongodb://h2/ef?w=1'])
+    codes = ['code{}'.format(i) for i in range(100)]
+    assert [before.shard_for(code) for code in codes] == \
+        [after.shard_for(code) for code in codes]
+    assert set(before.shards) == {'a', 'b'}
+    before.close()
+    after.close()
+
+
+def test_sharded_db():
+    uris = shard_uris(3)
+    drop_shards(uris)
+    db = DB(TEST_MONGO_URL, shard_uris=uris[:2])
+    build_indexes(db, INDEXES_V1 + INDEXES_V4 + INDEXES_V6)
+    user_id = ObjectId()
+
+    codes = []
+    for i in range(12):
+        code = db.generate_url_code('http://ef.me')
+        codes.append(code)
+        db.insert_url({
+            'code': code,
+            'long_url': 'http://{}.com'.format(i),
+            'url_access': [],
+            'created_at': datetime.datetime(2017, 1, 1, 0, i),
+            'created_by': user_id,
+        })
+
+    # urls land on the shard owning their code
+    for code in codes:
+        conn, database = db.shards[db.shard_for(code)]
+        assert conn[database].urls.find_one({'code': code})
+        assert db.find_one_url({'code': code})['code'] == code
+
+    # access logs are routed by code
+    db.log_access(codes[0], {'date': datetime.datetime.utcnow()})
+    assert len(db.find_one_url({'code': codes[0]})['url_access']) == 1
+
+    # every shard keeps its own aggregation checkpoint
+    until = datetime.datetime.utcnow().replace(microsecond=0)
+    until += datetime.timedelta(seconds=1)
+    assert aggregate(db, until=until) == 1
+    for urls in db.url_collections():
+        assert db.get_checkpoint('click_rollups', urls) == until
+
+    # scattered queries still work
+    assert db.find_one_url({'long_url': 'http://3.com'})['code'] == codes[3]
+    page = db.find_urls(user_id, page=2)
+    assert [url['code'] for url in page] == codes[::-1][5:10]
+
+    # growing to three shards moves only misplaced urls, with their rollups
+    stats = rebalance(TEST_MONGO_URL, uris[:2], uris)
+    assert stats['scanned'] == 12
+    db.close()
+
+    db = DB(TEST_MONGO_URL, shard_uris=uris)
+    for code in codes:
+        conn, database = db.shards[db.shard_for(code)]
+        assert conn[database].urls.find_one({'code': code})
+    assert sum(urls.count() for urls in db.url_collections()) == 12
+    rollups = db.find_rollups(codes[0], 'day', 10)
+    assert [i['clicks'] for i in rollups] == [1]
+    clicks = db.url_collection(codes[0]).database.url_clicks
+    assert clicks.count({'code': codes[0]}) == 1
+    db.close()
+
+    drop_shards(uris)
+
+
+"""
+Rate limit test
+"""
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeCounterStore:
+    """
+    In memory stand-in for the shared counter store
+    """
+    def __init__(self):
+        self.counters = {}
+
+    def incr(self, key, window_start, window, amount):
+        counter = (key, window_start)
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+        return self.counters[counter]
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=2, now=0)
+    assert bucket.consume(0) == 0
+    assert bucket.consume(0) == 0
+    assert bucket.consume(0) == 0.5
+
+    # refills with time, never over burst
+    assert bucket.consume(0.5) == 0
+    assert bucket.consume(100) == 0
+    assert bucket.tokens == 1
+
+
+def test_rate_limiter():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=1, burst=2, clock=clock, max_keys=2)
+    assert limiter.hit('a') == 0
+    assert limiter.hit('a') == 0
+    assert limiter.hit('a') == 1
+
+    clock.now += 1
+    assert limiter.hit('a') == 0
+
+    # least recently used keys are evicted
+    limiter.hit('b')
+    limiter.hit('c')
+    assert list(limiter.buckets) == ['b', 'c']
+
+    # blocks are evicted along with their buckets
+    limiter.blocked['b'] = clock.now + 60
+    limiter.hit('d')
+    assert 'b' not in limiter.blocked
+
+
+def test_rate_limiter_shared_store():
+    clock = FakeClock()
+    store = FakeCounterStore()
+    # 2 workers sharing a window limit of 1 * 10 + 5 = 15 hits
+    workers = [RateLimiter(rate=1, burst=5, store=store, window=10,
+                           sync_every=1, clock=clock) for _ in range(2)]
+
+    allowed = 0
+    for _ in range(5):
+        for worker in workers:
+            clock.now += 0.25
+            if not worker.hit('a'):
+                allowed += 1
+    # local buckets allow every hit, the shared total still holds
+    assert allowed == 10
+
+    for _ in range(6):
+        for worker in workers:
+            clock.now += 0.1
+            worker.hit('a')
+    retry_after = workers[0].hit('a')
+    assert 0 < retry_after <= 10
+    assert sum(store.counters.values()) > 15